@@ -25,19 +25,22 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
-import json
+import bisect
+import heapq
+import sys
 import numpy as np
 from collections import Counter
-from collections import Sized
 from pathlib import Path
 from pprint import pprint
 from sklearn import svm, metrics, preprocessing
-from sklearn.base import clone, is_classifier
 from sklearn.cross_validation import LabelKFold
-from sklearn.cross_validation import check_cv
 from sklearn.externals.joblib import Parallel, delayed
-from sklearn.grid_search import GridSearchCV, RandomizedSearchCV, ParameterSampler, ParameterGrid
-from sklearn.utils.validation import _num_samples, indexable
+
+from training import (ModifiedBayesSearchCV, ModifiedGridSearchCV, ModifiedHalvingSearchCV, ModifiedRandomizedSearchCV,
+                      ModifiedRefineSearchCV, MultiScorer, NystroemSVC, ReducedSVC, Twobias_scorer_CV, WorkQueue,
+                      compressed_size, cross_val_probs, cross_val_probs_compressed, f1Bias_scorer_CV, parseCSVBlock,
+                      platt_probability, platt_scaling, prune_param_grid, readCached, saveModel, saveModelBinary,
+                      writeFeatureStore)
 
 # Command line parameter configuration
 
@@ -47,181 +50,82 @@ parser.add_argument('--featureFolder', dest='featureFolder', required=True,
 parser.add_argument('--scorer', type=str, required=True, dest='scorer',
                     help='Specify which scorer function to use (f1 or twobias)')
 parser.add_argument('--whichsearch', type=str, required=True, dest='whichsearch',
-                    help='Specify which search function to use (GridSearch or RandomizedSearch')
+                    help='Specify which search function to use (grid, halving, refine, bayes or RandomizedSearch)')
+parser.add_argument('--alsoScore', type=str, nargs='+', required=False, choices=['f1', 'twobias'],
+                    dest='alsoScore', help='Also rank candidates by these scorers, from the same out-of-fold runs')
 parser.add_argument('--n_iter', type=int, required=False, dest='n_iter',
-                    help='If Randomized Search is used, how many iterations to use')
+                    help='If Randomized Search or bayes search is used, how many candidates to evaluate')
+parser.add_argument('--keepProbs', type=int, required=False, default=1, dest='keepProbs',
+                    help='Keep the out-of-fold probabilities of this many top candidates; 0 refits the folds')
+parser.add_argument('--factor', type=int, required=False, default=3, dest='factor',
+                    help='If halving search is used, keep 1/factor of the candidates and grow the folds by factor')
+parser.add_argument('--minFolds', type=int, required=False, default=2, dest='minFolds',
+                    help='If halving search is used, number of subject folds in the first round')
+parser.add_argument('--coarseStep', type=float, required=False, default=2.0, dest='coarseStep',
+                    help='If refine search is used, log2 spacing of the initial C/gamma lattice')
+parser.add_argument('--finalStep', type=float, required=False, default=0.5, dest='finalStep',
+                    help='If refine search is used, log2 spacing at which refinement stops')
+parser.add_argument('--topK', type=int, required=False, default=5, dest='topK',
+                    help='If refine search is used, number of best candidates refined in each round')
+parser.add_argument('--nInitial', type=int, required=False, default=20, dest='nInitial',
+                    help='If bayes search is used, number of random candidates before the surrogate is fitted')
+parser.add_argument('--patience', type=int, required=False, default=3, dest='patience',
+                    help='If bayes search is used, stop after this many rounds without improvement')
+parser.add_argument('--decisionScores', action='store_true', dest='decisionScores',
+                    help='Fit with probability=False and rank on decision function values, calibrating the final '
+                         'model once')
+parser.add_argument('--maxIter', type=int, required=False, default=-1, dest='maxIter',
+                    help='Solver iterations a fit may take before its candidate is marked failed (-1: no limit)')
+parser.add_argument('--workQueue', type=str, required=False, dest='workQueue',
+                    help='Directory shared with worker processes, which then run the (candidate, fold) fits')
+parser.add_argument('--worker', action='store_true', dest='worker',
+                    help='Serve the --workQueue of a search instead of searching; run with the same arguments')
+parser.add_argument('--taskTimeout', type=float, required=False, default=600, dest='taskTimeout',
+                    help='Seconds without a heartbeat after which a claimed --workQueue task is handed out again, and '
+                         'without any progress after which the search gives up')
+parser.add_argument('--fitTimeout', type=float, required=False, dest='fitTimeout',
+                    help='Seconds after which a fit is killed, its candidate marked failed and its other folds '
+                         'skipped; each fit then runs in a child process')
+parser.add_argument('--approx', action='store_true', dest='approx',
+                    help='Train a linear model on a Nystroem approximation of the RBF kernel of each gamma, ranking on '
+                         'decision function values as with --decisionScores')
+parser.add_argument('--approxComponents', type=int, required=False, default=500, dest='approxComponents',
+                    help='If --approx is used, number of training windows the kernel approximation is built on')
+parser.add_argument('--approxLoss', type=str, required=False, default='squared_hinge',
+                    choices=['squared_hinge', 'hinge', 'logistic'], dest='approxLoss',
+                    help='If --approx is used, train a linear SVM with this loss or a logistic regression')
+parser.add_argument('--precomputeKernel', action='store_true', dest='precomputeKernel',
+                    help='Compute each RBF kernel matrix once per gamma and share it across C and class_weight')
+parser.add_argument('--kernelCacheMB', type=int, required=False, dest='kernelCacheMB',
+                    help='Memory budget in megabytes for the kernel matrices computed with --precomputeKernel and '
+                         'the fold slices of them that the local workers fit on (default: half the physical memory)')
+parser.add_argument('--memmapFolder', type=str, required=False, dest='memmapFolder',
+                    help='Directory where the training matrix is memory-mapped once and shared with all workers')
+parser.add_argument('--foldParallel', action='store_true', dest='foldParallel',
+                    help='Schedule every (candidate, fold) pair as its own task instead of one task per candidate')
+parser.add_argument('--resultStore', type=str, required=False, dest='resultStore',
+                    help='SQLite file recording every evaluated candidate, so an interrupted search can resume')
 parser.add_argument('--modelOutput', type=str, required=True, dest='modelOutput',
                     help='Model file to write')
+parser.add_argument('--modelBinary', type=str, required=False, dest='modelBinary',
+                    help='Also write the model in the memory-mappable binary format to this file')
+parser.add_argument('--compress', type=float, nargs='+', required=False, dest='compress',
+                    help='Report the out-of-fold score of the model compressed to fewer vectors by these factors')
+parser.add_argument('--compressedOutput', type=str, required=False, dest='compressedOutput',
+                    help='Write the model compressed by the first --compress factor to this file')
 parser.add_argument('--featureFile', type=str, required=True, dest='featureFile',
                     help='Feature vector file name')
 parser.add_argument('--stressFile', type=str, required=True, dest='stressFile',
                     help='Stress ground truth filename')
+parser.add_argument('--streamFolder', type=str, required=False, dest='streamFolder',
+                    help='Label and normalize the features file by file into a disk-backed store in this directory')
+parser.add_argument('--chunkSize', type=int, required=False, default=100000, dest='chunkSize',
+                    help='Rows per chunk when streaming features into --streamFolder')
+parser.add_argument('--cacheFolder', type=str, required=False, dest='cacheFolder',
+                    help='Directory for parsed copies of the input files, refreshed when a file changes')
 args = parser.parse_args()
 
 
-def cv_fit_and_score(estimator, X, y, scorer, parameters, cv, ):
-    """Fit estimator and compute scores for a given dataset split.
-    Parameters
-    ----------
-    estimator : estimator object implementing 'fit'
-        The object to use to fit the data.
-    X : array-like of shape at least 2D
-        The data to fit.
-    y : array-like, optional, default: None
-        The target variable to try to predict in the case of
-        supervised learning.
-    scorer : callable
-        A scorer callable object / function with signature
-        ``scorer(estimator, X, y)``.
-    parameters : dict or None
-        Parameters to be set on the estimator.
-    cv:	Cross-validation fold indeces
-    Returns
-    -------
-    score : float
-        CV score on whole set.
-    parameters : dict or None, optional
-        The parameters that have been evaluated.
-    """
-    estimator.set_params(**parameters)
-    cv_probs_ = cross_val_probs(estimator, X, y, cv)
-    score = scorer(cv_probs_, y)
-
-    return [score, parameters]  # scoring_time]
-
-
-class ModifiedGridSearchCV(GridSearchCV):
-    def __init__(self, estimator, param_grid, scoring=None, fit_params=None,
-                 n_jobs=1, iid=True, refit=True, cv=None, verbose=0,
-                 pre_dispatch='2*n_jobs', error_score='raise'):
-
-        super(ModifiedGridSearchCV, self).__init__(
-                estimator, param_grid, scoring, fit_params, n_jobs, iid,
-                refit, cv, verbose, pre_dispatch, error_score)
-
-    def fit(self, X, y):
-        """Actual fitting,  performing the search over parameters."""
-
-        parameter_iterable = ParameterGrid(self.param_grid)
-
-        estimator = self.estimator
-        cv = self.cv
-
-        n_samples = _num_samples(X)
-        X, y = indexable(X, y)
-
-        if y is not None:
-            if len(y) != n_samples:
-                raise ValueError('Target variable (y) has a different number '
-                                 'of samples (%i) than data (X: %i samples)'
-                                 % (len(y), n_samples))
-        cv = check_cv(cv, X, y, classifier=is_classifier(estimator))
-
-        if self.verbose > 0:
-            if isinstance(parameter_iterable, Sized):
-                n_candidates = len(parameter_iterable)
-                print("Fitting {0} folds for each of {1} candidates, totalling"
-                      " {2} fits".format(len(cv), n_candidates,
-                                         n_candidates * len(cv)))
-
-        base_estimator = clone(self.estimator)
-
-        pre_dispatch = self.pre_dispatch
-
-        out = Parallel(
-                n_jobs=self.n_jobs, verbose=self.verbose,
-                pre_dispatch=pre_dispatch
-        )(
-                delayed(cv_fit_and_score)(clone(base_estimator), X, y, self.scoring,
-                                          parameters, cv=cv)
-                for parameters in parameter_iterable)
-
-        best = sorted(out, reverse=True)[0]
-        self.best_params_ = best[1]
-        self.best_score_ = best[0]
-
-        if self.refit:
-            # fit the best estimator using the entire dataset
-            # clone first to work around broken estimators
-            best_estimator = clone(base_estimator).set_params(
-                    **best[1])
-            if y is not None:
-                best_estimator.fit(X, y, **self.fit_params)
-            else:
-                best_estimator.fit(X, **self.fit_params)
-            self.best_estimator_ = best_estimator
-
-        return self
-
-
-class ModifiedRandomizedSearchCV(RandomizedSearchCV):
-    def __init__(self, estimator, param_distributions, n_iter=10, scoring=None,
-                 fit_params=None, n_jobs=1, iid=True, refit=True, cv=None,
-                 verbose=0, pre_dispatch='2*n_jobs', random_state=None,
-                 error_score='raise'):
-
-        super(ModifiedRandomizedSearchCV, self).__init__(estimator=estimator, param_distributions=param_distributions,
-                                                         n_iter=n_iter, scoring=scoring, random_state=random_state,
-                                                         fit_params=fit_params, n_jobs=n_jobs, iid=iid, refit=refit,
-                                                         cv=cv, verbose=verbose, pre_dispatch=pre_dispatch,
-                                                         error_score=error_score)
-
-    def fit(self, X, y):
-        """Actual fitting,  performing the search over parameters."""
-
-        parameter_iterable = ParameterSampler(self.param_distributions,
-                                              self.n_iter,
-                                              random_state=self.random_state)
-        estimator = self.estimator
-        cv = self.cv
-
-        n_samples = _num_samples(X)
-        X, y = indexable(X, y)
-
-        if y is not None:
-            if len(y) != n_samples:
-                raise ValueError('Target variable (y) has a different number '
-                                 'of samples (%i) than data (X: %i samples)'
-                                 % (len(y), n_samples))
-        cv = check_cv(cv, X, y, classifier=is_classifier(estimator))
-
-        if self.verbose > 0:
-            if isinstance(parameter_iterable, Sized):
-                n_candidates = len(parameter_iterable)
-                print("Fitting {0} folds for each of {1} candidates, totalling"
-                      " {2} fits".format(len(cv), n_candidates,
-                                         n_candidates * len(cv)))
-
-        base_estimator = clone(self.estimator)
-
-        pre_dispatch = self.pre_dispatch
-
-        out = Parallel(
-                n_jobs=self.n_jobs, verbose=self.verbose,
-                pre_dispatch=pre_dispatch
-        )(
-                delayed(cv_fit_and_score)(clone(base_estimator), X, y, self.scoring,
-                                          parameters, cv=cv)
-                for parameters in parameter_iterable)
-
-        best = sorted(out, reverse=True)[0]
-        self.best_params_ = best[1]
-        self.best_score_ = best[0]
-
-        if self.refit:
-            # fit the best estimator using the entire dataset
-            # clone first to work around broken estimators
-            best_estimator = clone(base_estimator).set_params(
-                    **best[1])
-            if y is not None:
-                best_estimator.fit(X, y, **self.fit_params)
-            else:
-                best_estimator.fit(X, **self.fit_params)
-            self.best_estimator_ = best_estimator
-
-        return self
-
-
 def decodeLabel(label):
     label = label[:2]  # Only the first 2 characters designate the label code
 
@@ -230,27 +134,66 @@ def decodeLabel(label):
     return mapping[label]
 
 
-def readFeatures(folder, filename):
-    features = []
+def parseFeatureFile(f):
+    block = parseCSVBlock(f)
+
+    return {'timestamps': block[:, 0].astype(np.int64), 'features': np.ascontiguousarray(block[:, 1:])}
 
+
+def readFeatureFile(filename, cacheFolder=None):
+    return readCached(Path(filename), parseFeatureFile, cacheFolder)
+
+
+def readFeatureMatrix(folder, filename, cacheFolder=None, n_jobs=1):
+    """Read every feature file under folder into arrays of participant IDs, window start times and features.
+
+    Files are parsed in parallel, each straight into a NumPy block, and the blocks are concatenated into one
+    contiguous float64 feature matrix.
+    """
     path = Path(folder)
     files = list(path.glob('**/' + filename))
 
-    for f in files:
-        participantID = int(f.parent.name[2:])
-        with f.open() as file:
-            for line in file.readlines():
-                parts = [x.strip() for x in line.split(',')]
+    blocks = Parallel(n_jobs=n_jobs)(delayed(readFeatureFile)(str(f), cacheFolder) for f in files)
+    blocks = [(int(f.parent.name[2:]), data) for f, data in zip(files, blocks) if len(data['timestamps']) > 0]
+    if not blocks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 0))
+
+    participants = np.concatenate([np.repeat(participantID, len(data['timestamps'])) for participantID, data in blocks])
+    timestamps = np.concatenate([data['timestamps'] for participantID, data in blocks])
+    features = np.concatenate([data['features'] for participantID, data in blocks])
+
+    return participants, timestamps, features
+
 
-                featureVector = [participantID, int(parts[0])]
-                featureVector.extend([float(p) for p in parts[1:]])
+def readFeatures(folder, filename, cacheFolder=None):
+    features = []
+
+    participants, timestamps, values = readFeatureMatrix(folder, filename, cacheFolder)
+    for participantID, ts, featureValues in zip(participants.tolist(), timestamps.tolist(), values.tolist()):
+        featureVector = [participantID, ts]
+        featureVector.extend(featureValues)
 
-                features.append(featureVector)
+        features.append(featureVector)
 
     return features
 
 
-def readStressmarks(folder, filename):
+def parseStressmarkFile(f):
+    labels = []
+    starts = []
+    ends = []
+    with f.open() as file:
+        for line in file.readlines():
+            parts = [x.strip() for x in line.split(',')]
+            labels.append(parts[0][:2])
+            starts.append(int(parts[2]))
+            ends.append(int(parts[3]))
+
+    return {'labels': np.array(labels, dtype='S2'), 'starts': np.array(starts, dtype=np.int64),
+            'ends': np.array(ends, dtype=np.int64)}
+
+
+def readStressmarks(folder, filename, cacheFolder=None):
     features = []
 
     path = Path(folder)
@@ -258,12 +201,10 @@ def readStressmarks(folder, filename):
 
     for f in files:
         participantID = int(f.parent.name[2:])
+        data = readCached(f, parseStressmarkFile, cacheFolder)
 
-        with f.open() as file:
-            for line in file.readlines():
-                parts = [x.strip() for x in line.split(',')]
-                label = parts[0][:2]
-                features.append([participantID, label, int(parts[2]), int(parts[3])])
+        for label, start, end in zip(data['labels'].tolist(), data['starts'].tolist(), data['ends'].tolist()):
+            features.append([participantID, label, start, end])
 
     return features
 
@@ -282,233 +223,136 @@ def checkStressMark(stressMark, pid, starttime):
     return data.most_common(1)
 
 
-def analyze_events_with_features(features, stress_marks):
-    featureLabels = []
-    finalFeatures = []
-    subjects = []
-
-    startTimes = {}
-    for pid, label, start, end in stress_marks:
-        if label == 'c4':
-            if pid not in startTimes:
-                startTimes[pid] = np.inf
-
-            startTimes[pid] = min(startTimes[pid], start)
-
-    for line in features:
-        id = line[0]
-        ts = line[1]
-        f = line[2:]
-
-        if ts < startTimes[id]:
-            continue  # Outside of starting time
-
-        label = checkStressMark(stress_marks, id, ts)
-        if len(label) > 0:
-            stressClass = decodeLabel(label[0][0])
-
-            featureLabels.append(stressClass)
-            finalFeatures.append(f)
-            subjects.append(id)
-
-    return finalFeatures, featureLabels, subjects
-
-
-def get_svmdataset(traindata, trainlabels):
-    input = []
-    output = []
-    foldinds = []
-
-    for i in range(len(trainlabels)):
-        if trainlabels[i] == 1:
-            foldinds.append(i)
-
-        if trainlabels[i] == 0:
-            foldinds.append(i)
-
-    input = np.array(input, dtype='float64')
-    return output, input, foldinds
-
+def checkStressMarks(stressMark, windows):
+    """Label many windows at once; equivalent to [checkStressMark(stressMark, pid, ts) for pid, ts in windows].
 
-def reduceData(data, r):
-    result = []
-    for d in data:
-        result.append([d[i] for i in r])
-    return result
-
-
-def f1Bias_scorer(estimator, X, y, ret_bias=False):
-    probas_ = estimator.predict_proba(X)
-    precision, recall, thresholds = metrics.precision_recall_curve(y, probas_[:, 1])
-
-    f1 = 0.0
-    for i in range(0, len(thresholds)):
-        if not (precision[i] == 0 and recall[i] == 0):
-            f = 2 * (precision[i] * recall[i]) / (precision[i] + recall[i])
-            if f > f1:
-                f1 = f
-                bias = thresholds[i]
-
-    if ret_bias:
-        return f1, bias
-    else:
-        return f1
-
-
-def Twobias_scorer_CV(probs, y, ret_bias=False):
-    db = np.transpose(np.vstack([probs, y]))
-    db = db[np.argsort(db[:, 0]), :]
-
-    pos = np.sum(y == 1)
-    n = len(y)
-    neg = n - pos
-    tp, tn = pos, 0
-    lost = 0
-
-    optbias = []
-    minloss = 1
-
-    for i in range(n):
-        #		p = db[i,1]
-        if db[i, 1] == 1:  # positive
-            tp -= 1.0
-        else:
-            tn += 1.0
-
-        # v1 = tp/pos
-        #		v2 = tn/neg
-        if tp / pos >= 0.95 and tn / neg >= 0.95:
-            optbias = [db[i, 0], db[i, 0]]
+    Stress marks are grouped by participant and sorted by start time, and each participant's windows are swept
+    in start time order. A mark enters the active set once its start is strictly before the window start (found
+    by bisection) and leaves it for good once its end is no longer strictly after the window end, since window
+    ends only grow along the sweep. The active marks are handed to Counter in their original file order so that
+    most_common(1) breaks ties exactly like checkStressMark.
+    """
+    marks = {}
+    for index, (id, gt, st, et) in enumerate(stressMark):
+        if gt not in ['c7']:
+            marks.setdefault(id, []).append((st, et, index, gt))
+
+    order = {}
+    for position, (pid, starttime) in enumerate(windows):
+        order.setdefault(pid, []).append((starttime, position))
+
+    labels = [[] for _ in windows]
+    for pid, pidWindows in order.items():
+        if pid not in marks:
             continue
 
-        running_pos = pos
-        running_neg = neg
-        running_tp = tp
-        running_tn = tn
-
-        for j in range(i + 1, n):
-            #			p1 = db[j,1]
-            if db[j, 1] == 1:  # positive
-                running_tp -= 1.0
-                running_pos -= 1
-            else:
-                running_neg -= 1
-
-            lost = (j - i) * 1.0 / n
-            if running_pos == 0 or running_neg == 0:
-                break
-
-            # v1 = running_tp/running_pos
-            #			v2 = running_tn/running_neg
-
-            if running_tp / running_pos >= 0.95 and running_tn / running_neg >= 0.95 and lost < minloss:
-                minloss = lost
-                optbias = [db[i, 0], db[j, 0]]
-
-    if ret_bias:
-        return -minloss, optbias
-    else:
-        return -minloss
+        pidMarks = sorted(marks[pid])
+        starts = [st for st, et, index, gt in pidMarks]
+        ends = []
+        active = {}
+        added = 0
 
+        for starttime, position in sorted(pidWindows):
+            endtime = starttime + 60000  # One minute windows
 
-def f1Bias_scorer_CV(probs, y, ret_bias=False):
-    precision, recall, thresholds = metrics.precision_recall_curve(y, probs)
+            upto = bisect.bisect_left(starts, starttime)
+            for st, et, index, gt in pidMarks[added:upto]:
+                heapq.heappush(ends, (et, index))
+                active[index] = gt
+            added = max(added, upto)
 
-    f1 = 0.0
-    for i in range(0, len(thresholds)):
-        if not (precision[i] == 0 and recall[i] == 0):
-            f = 2 * (precision[i] * recall[i]) / (precision[i] + recall[i])
-            if f > f1:
-                f1 = f
-                bias = thresholds[i]
+            while ends and ends[0][0] <= endtime:
+                active.pop(heapq.heappop(ends)[1])
 
-    if ret_bias:
-        return f1, bias
-    else:
-        return f1
+            if active:
+                labels[position] = Counter([active[index] for index in sorted(active)]).most_common(1)
 
+    return labels
 
-def svmOutput(filename, traindata, trainlabels):
-    with open(filename, 'w') as f:
-        for i in range(0, len(trainlabels)):
-            f.write(str(trainlabels[i]))
-            for fi in range(0, len(traindata[i])):
-                f.write(" " + str(fi + 1) + ":" + str(traindata[i][fi]))
 
-            f.write("\n")
+def analyze_feature_matrix(participants, timestamps, features, stress_marks):
+    """Array version of analyze_events_with_features: returns the labeled rows of features, their labels
+    and their participant IDs as arrays."""
+    startTimes = {}
+    for pid, label, start, end in stress_marks:
+        if label == 'c4':
+            if pid not in startTimes:
+                startTimes[pid] = np.inf
 
+            startTimes[pid] = min(startTimes[pid], start)
 
-def saveModel(filename, model, normparams, bias=0.5):
-    class Object:
-        def to_JSON(self):
-            return json.dumps(self, default=lambda o: o.__dict__,
-                              sort_keys=True, indent=4)
+    firstStart = np.zeros(len(participants))
+    for pid in np.unique(participants):
+        firstStart[participants == pid] = startTimes[pid]
+    windows = np.where(timestamps >= firstStart)[0]  # Outside of starting time otherwise
 
-    class Kernel(Object):
-        def __init__(self, type, parameters):
-            self.type = type
-            self.parameters = parameters
+    labels = checkStressMarks(stress_marks, zip(participants[windows].tolist(), timestamps[windows].tolist()))
+    labeled = np.array([len(label) > 0 for label in labels], dtype=bool)
+    featureLabels = np.array([decodeLabel(label[0][0]) for label in labels if len(label) > 0], dtype=np.int64)
 
-    class KernelParam(Object):
-        def __init__(self, name, value):
-            self.name = name;
-            self.value = value
+    rows = windows[labeled]
+    return features[rows], featureLabels, participants[rows]
 
-    class Support(Object):
-        def __init__(self, dualCoef, supportVector):
-            self.dualCoef = dualCoef
-            self.supportVector = supportVector
 
-    class NormParam(Object):
-        def __init__(self, mean, std):
-            self.mean = mean
-            self.std = std
+def analyze_events_with_features(features, stress_marks):
+    participants = np.array([line[0] for line in features], dtype=np.int64)
+    timestamps = np.array([line[1] for line in features], dtype=np.int64)
+    values = np.array([line[2:] for line in features], dtype=np.float64)
 
-    class SVCModel(Object):
-        def __init__(self, modelName, modelType, intercept, bias, probA, probB, kernel, support, normparams):
-            self.modelName = modelName;
-            self.modelType = modelType;
-            self.intercept = intercept;
-            self.bias = bias;
-            self.probA = probA;
-            self.probB = probB;
-            self.kernel = kernel
-            self.support = support
-            self.normparams = normparams
+    finalFeatures, featureLabels, subjects = analyze_feature_matrix(participants, timestamps, values, stress_marks)
 
-    model = SVCModel('cStress', 'svc', model.intercept_[0], bias, model.probA_[0], model.probB_[0],
-                     Kernel('rbf', [KernelParam('gamma', model._gamma)]),
-                     [Support(model.dual_coef_[0][i], list(model.support_vectors_[i])) for i in
-                      range(len(model.dual_coef_[0]))],
-                     [NormParam(normparams.mean_[i], normparams.scale_[i]) for i in range(len(normparams.scale_))])
+    return finalFeatures.tolist(), featureLabels.tolist(), subjects.tolist()
 
-    with open(filename, 'w') as f:
-        print >> f, model.to_JSON()
 
+def iterLabeledChunks(folder, filename, stress_marks, chunk_size=100000, cacheFolder=None):
+    """Yield (features, labels, participants) chunks of at most chunk_size labeled windows.
 
-def cross_val_probs(estimator, X, y, cv):
-    probs = np.zeros(len(y))
+    Feature files are read and labeled one at a time, so memory is bounded by the largest file rather than
+    by the whole feature folder. The marks are split by participant once, and each file is labeled against
+    its own participant's marks only.
+    """
+    marksByParticipant = {}
+    for mark in stress_marks:
+        marksByParticipant.setdefault(mark[0], []).append(mark)
 
-    for train, test in cv:
-        temp = estimator.fit(X[train], y[train]).predict_proba(X[test])
-        probs[test] = temp[:, 1]
+    for f in sorted(Path(folder).glob('**/' + filename)):
+        data = readFeatureFile(str(f), cacheFolder)
+        if len(data['timestamps']) == 0:
+            continue
 
-    return probs
+        pid = int(f.parent.name[2:])
+        participants = np.repeat(pid, len(data['timestamps']))
+        features, featureLabels, subjects = analyze_feature_matrix(participants, data['timestamps'],
+                                                                   data['features'], marksByParticipant.get(pid, []))
+        for start in range(0, len(featureLabels), chunk_size):
+            yield (features[start:start + chunk_size], featureLabels[start:start + chunk_size],
+                   subjects[start:start + chunk_size])
 
 
 # This tool accepts the data produced by the Java cStress implementation and trains and evaluates an SVM model with
 # cross-subject validation
 if __name__ == '__main__':
-    features = readFeatures(args.featureFolder, args.featureFile)
-    groundtruth = readStressmarks(args.featureFolder, args.stressFile)
+    if args.worker:
+        WorkQueue(args.workQueue, args.taskTimeout).serve()
+        sys.exit()
 
-    traindata, trainlabels, subjects = analyze_events_with_features(features, groundtruth)
+    groundtruth = readStressmarks(args.featureFolder, args.stressFile, args.cacheFolder)
 
-    traindata = np.asarray(traindata, dtype=np.float64)
-    trainlabels = np.asarray(trainlabels)
+    if args.streamFolder:
+        chunks = iterLabeledChunks(args.featureFolder, args.featureFile, groundtruth, args.chunkSize,
+                                   args.cacheFolder)
+        traindata, trainlabels, subjects, normalizer = writeFeatureStore(chunks, args.streamFolder, args.chunkSize)
+    else:
+        participants, timestamps, features = readFeatureMatrix(args.featureFolder, args.featureFile,
+                                                               args.cacheFolder, n_jobs=-1)
+
+        traindata, trainlabels, subjects = analyze_feature_matrix(participants, timestamps, features, groundtruth)
+
+        traindata = np.asarray(traindata, dtype=np.float64)
+        trainlabels = np.asarray(trainlabels)
 
-    normalizer = preprocessing.StandardScaler()
-    traindata = normalizer.fit_transform(traindata)
+        normalizer = preprocessing.StandardScaler()
+        traindata = normalizer.fit_transform(traindata)
 
     lkf = LabelKFold(subjects, n_folds=len(np.unique(subjects)))
 
@@ -517,29 +361,107 @@ if __name__ == '__main__':
                   'C': [2 ** x for x in np.arange(-12, 12, 0.5)],
                   'gamma': [2 ** x for x in np.arange(-12, 12, 0.5)],
                   'class_weight': [{0: w, 1: 1 - w} for w in np.arange(0.0, 1.0, delta)]}
-
-    svc = svm.SVC(probability=True, verbose=False, cache_size=2000)
+    parameters, degenerate = prune_param_grid(parameters)
+    if degenerate:
+        print "Dropped degenerate class weights:", degenerate
+
+    if args.approx:
+        if args.precomputeKernel:
+            parser.error('--approx does not fit exact kernels, so it cannot be combined with --precomputeKernel')
+        svc = NystroemSVC(n_components=args.approxComponents, loss=args.approxLoss, random_state=0)
+        if args.maxIter > 0:
+            svc.set_params(max_iter=args.maxIter)
+    else:
+        svc = svm.SVC(probability=not args.decisionScores, verbose=False, cache_size=2000,
+                      max_iter=args.maxIter)
 
     if args.scorer == 'f1':
         scorer = f1Bias_scorer_CV
     else:
         scorer = Twobias_scorer_CV
 
+    search_scorer = scorer
+    if args.alsoScore:
+        # Secondary objectives are scored from the same out-of-fold probabilities, without extra fits
+        search_scorer = MultiScorer([scorer] + [{'f1': f1Bias_scorer_CV, 'twobias': Twobias_scorer_CV}[name]
+                                                for name in args.alsoScore])
+
     if args.whichsearch == 'grid':
-        clf = ModifiedGridSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=scorer, verbose=1, iid=False)
+        clf = ModifiedGridSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=search_scorer, verbose=1, iid=False,
+                                   precompute_kernel=args.precomputeKernel, kernel_cache_mb=args.kernelCacheMB,
+                                   memmap_folder=args.memmapFolder, fold_parallel=args.foldParallel,
+                                   result_store=args.resultStore, keep_probs=args.keepProbs,
+                                   fit_timeout=args.fitTimeout, work_queue=args.workQueue,
+                                   task_timeout=args.taskTimeout)
+    elif args.whichsearch == 'halving':
+        clf = ModifiedHalvingSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=search_scorer, verbose=1, iid=False,
+                                      precompute_kernel=args.precomputeKernel, kernel_cache_mb=args.kernelCacheMB,
+                                      memmap_folder=args.memmapFolder, fold_parallel=args.foldParallel,
+                                      result_store=args.resultStore, keep_probs=args.keepProbs,
+                                      fit_timeout=args.fitTimeout, work_queue=args.workQueue,
+                                      task_timeout=args.taskTimeout, factor=args.factor, min_folds=args.minFolds)
+    elif args.whichsearch == 'refine':
+        clf = ModifiedRefineSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=search_scorer, verbose=1, iid=False,
+                                     precompute_kernel=args.precomputeKernel, kernel_cache_mb=args.kernelCacheMB,
+                                     memmap_folder=args.memmapFolder, fold_parallel=args.foldParallel,
+                                     result_store=args.resultStore, keep_probs=args.keepProbs,
+                                     fit_timeout=args.fitTimeout, work_queue=args.workQueue,
+                                     task_timeout=args.taskTimeout, coarse_step=args.coarseStep,
+                                     final_step=args.finalStep, top_k=args.topK)
+    elif args.whichsearch == 'bayes':
+        clf = ModifiedBayesSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=search_scorer, verbose=1, iid=False,
+                                    precompute_kernel=args.precomputeKernel, kernel_cache_mb=args.kernelCacheMB,
+                                    memmap_folder=args.memmapFolder, fold_parallel=args.foldParallel,
+                                    result_store=args.resultStore, keep_probs=args.keepProbs,
+                                    fit_timeout=args.fitTimeout, work_queue=args.workQueue,
+                                    task_timeout=args.taskTimeout, n_iter=args.n_iter or 200,
+                                    n_initial=args.nInitial, patience=args.patience)
     else:
         clf = ModifiedRandomizedSearchCV(estimator=svc, param_distributions=parameters, cv=lkf, n_jobs=-1,
-                                         scoring=scorer, n_iter=args.n_iter,
-                                         verbose=1, iid=False)
-
-    clf.fit(traindata, trainlabels)
+                                         scoring=search_scorer, n_iter=args.n_iter,
+                                         verbose=1, iid=False, precompute_kernel=args.precomputeKernel,
+                                         kernel_cache_mb=args.kernelCacheMB, memmap_folder=args.memmapFolder,
+                                         fold_parallel=args.foldParallel, result_store=args.resultStore,
+                                         keep_probs=args.keepProbs, fit_timeout=args.fitTimeout,
+                                         work_queue=args.workQueue, task_timeout=args.taskTimeout)
+
+    try:
+        clf.fit(traindata, trainlabels)
+    finally:
+        # Workers exit also when the search fails, instead of polling the queue forever
+        if args.workQueue:
+            WorkQueue(args.workQueue).stop()
     pprint(clf.best_params_)
+    if args.alsoScore:
+        for name in search_scorer.names:
+            print("Best for %s: %f" % (name, clf.leaderboards_[name][0][0]))
+            pprint(clf.best_params_by_scorer_[name])
+
+    if args.compress:
+        compressed_vectors, compressed_probs = cross_val_probs_compressed(clf.best_estimator_, traindata, trainlabels,
+                                                                          lkf, args.compress, n_jobs=-1)
+        CV_probs = compressed_probs[0]
+    elif args.keepProbs:
+        # The search already has the best candidate's out-of-fold probabilities
+        CV_probs = clf.top_probs_[0][2]
+    else:
+        CV_probs = cross_val_probs(clf.best_estimator_, traindata, trainlabels, lkf, n_jobs=-1)
+
+    if not svc.probability:
+        # CV_probs holds decision function values: calibrate them once and give the refit model the sigmoid
+        probA, probB = platt_scaling(CV_probs, trainlabels)
+        clf.best_estimator_.probA_ = np.array([probA])
+        clf.best_estimator_.probB_ = np.array([probB])
+        CV_probs = platt_probability(CV_probs, probA, probB)
+        if args.compress:
+            compressed_probs = np.array([platt_probability(probs, probA, probB) for probs in compressed_probs])
 
-    CV_probs = cross_val_probs(clf.best_estimator_, traindata, trainlabels, lkf)
     score, bias = scorer(CV_probs, trainlabels, True)
     print score, bias
     if not bias == []:
         saveModel(args.modelOutput, clf.best_estimator_, normalizer, bias)
+        if args.modelBinary:
+            saveModelBinary(args.modelBinary, clf.best_estimator_, normalizer, bias)
 
         n = len(trainlabels)
 
@@ -558,3 +480,15 @@ if __name__ == '__main__':
         print("Subjects: " + str(np.unique(subjects)))
     else:
         print "Results not good"
+
+    if args.compress:
+        for factor, vectors, probs in zip(args.compress, compressed_vectors[1:], compressed_probs[1:]):
+            compressed_score, compressed_bias = scorer(probs, trainlabels, True)
+            print("Compressed %gx: %d vectors (%.1fx faster), score %f (%+f), bias %s" %
+                  (factor, vectors, compressed_vectors[0] / vectors, compressed_score, compressed_score - score,
+                   compressed_bias))
+
+        compressed_score, compressed_bias = scorer(compressed_probs[1], trainlabels, True)
+        if args.compressedOutput and not compressed_bias == []:
+            reduced = ReducedSVC(compressed_size(clf.best_estimator_, args.compress[0]))
+            saveModel(args.compressedOutput, reduced.fit(clf.best_estimator_, traindata), normalizer, compressed_bias)
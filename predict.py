@@ -0,0 +1,205 @@
+# Copyright (c) 2015, University of Memphis, MD2K Center of Excellence
+#  - Timothy Hnat <twhnat@memphis.edu>
+#  - Karen Hovsepian <karoaper@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import itertools
+import json
+import numpy as np
+
+parser = argparse.ArgumentParser(description='Score feature vectors with a cStress or puffMarker model')
+parser.add_argument('--model', type=str, required=True, dest='model',
+                    help='Model file written by saveModel or saveModelBinary')
+parser.add_argument('--featureFile', type=str, required=True, dest='featureFile',
+                    help='Feature vector file to score, one timestamp followed by the raw features per line')
+parser.add_argument('--output', type=str, required=True, dest='output',
+                    help='Output file of timestamp, probability and label per window')
+parser.add_argument('--memoryMB', type=int, required=False, default=256, dest='memoryMB',
+                    help='Memory cap for each block of windows scored at once')
+
+
+def coupled_probability(r, max_iter=100):
+    """Class 1 probability from the pairwise Platt estimates r of class 1 over class 0.
+
+    Runs the same iterative coupling libsvm applies to two classes (Wu, Lin and Weng 2004), vectorized over
+    windows, so that the results match SVC.predict_proba rather than the bare sigmoid.
+    """
+    eps = 0.005 / 2
+    Q = np.array([[r ** 2, -r * (1 - r)], [-r * (1 - r), (1 - r) ** 2]])
+    p = np.zeros((2, len(r))) + 0.5
+    active = np.ones(len(r), dtype=bool)
+
+    for iteration in range(max_iter):
+        Qp = np.array([Q[0, 0] * p[0] + Q[0, 1] * p[1], Q[1, 0] * p[0] + Q[1, 1] * p[1]])
+        pQp = p[0] * Qp[0] + p[1] * Qp[1]
+        active &= np.maximum(np.abs(Qp[0] - pQp), np.abs(Qp[1] - pQp)) >= eps
+        if not np.any(active):
+            break
+
+        for t in range(2):
+            diff = np.where(active, (pQp - Qp[t]) / Q[t, t], 0.0)
+            p[t] += diff
+            pQp = (pQp + diff * (diff * Q[t, t] + 2 * Qp[t])) / (1 + diff) ** 2
+            Qp = (Qp + diff * Q[t]) / (1 + diff)
+            p /= 1 + diff
+
+    return p[1]
+
+
+class SVMModel(object):
+    """An RBF SVC with Platt scaling and decision bias, held as contiguous NumPy arrays.
+
+    bias is either a single probability threshold or a [lower, upper] pair; with a pair, windows whose
+    probability falls strictly between the two thresholds are left unclassified.
+    """
+
+    def __init__(self, support_vectors, dual_coef, intercept, gamma, probA, probB, mean, std, bias=0.5):
+        self.support_vectors = np.ascontiguousarray(support_vectors, dtype=np.float64)
+        self.dual_coef = np.ascontiguousarray(dual_coef, dtype=np.float64)
+        self.intercept = float(intercept)
+        self.gamma = float(gamma)
+        self.probA = float(probA)
+        self.probB = float(probB)
+        self.mean = np.ascontiguousarray(mean, dtype=np.float64)
+        self.std = np.ascontiguousarray(std, dtype=np.float64)
+        self.bias = bias
+
+        self.support_norms = np.einsum('ij,ij->i', self.support_vectors, self.support_vectors)
+
+    def block_rows(self, memory_mb):
+        # Per window: the kernel row and its temporary, plus the parsed text, raw and normalized feature vector
+        row_bytes = 8 * (2 * len(self.support_vectors) + 6 * len(self.mean))
+        return max(1, int(memory_mb * 2 ** 20 / row_bytes))
+
+    def decision_function(self, X):
+        """Decision values of raw, unnormalized feature vectors X, positive for class 1."""
+        X = (np.asarray(X, dtype=np.float64) - self.mean) / self.std
+
+        K = np.dot(X, self.support_vectors.T)
+        K *= -2.0
+        K += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+        K += self.support_norms
+        np.maximum(K, 0.0, out=K)
+        K *= -self.gamma
+        np.exp(K, out=K)
+
+        return np.dot(K, self.dual_coef) + self.intercept
+
+    def predict_proba(self, X, memory_mb=256):
+        """Probability of class 1 for each row of X, as SVC.predict_proba computes it, scored in blocks bounded
+        by memory_mb."""
+        X = np.asarray(X, dtype=np.float64)
+        rows = self.block_rows(memory_mb)
+
+        probs = np.empty(len(X))
+        for start in range(0, len(X), rows):
+            sigmoid = 1.0 / (1.0 + np.exp(self.probA * self.decision_function(X[start:start + rows]) - self.probB))
+            probs[start:start + rows] = coupled_probability(np.clip(sigmoid, 1e-7, 1 - 1e-7))
+        return probs
+
+    def predict(self, X, memory_mb=256):
+        """Labels of the rows of X: 1 or 0, or -1 for windows left between the two biases."""
+        return self.label(self.predict_proba(X, memory_mb))
+
+    def label(self, probs):
+        if isinstance(self.bias, list):
+            labels = np.asarray(probs >= self.bias[1], dtype=np.int)
+            labels[np.logical_and(probs > self.bias[0], probs < self.bias[1])] = -1
+            return labels
+        return np.asarray(probs >= self.bias, dtype=np.int)
+
+
+# Binary model layout written by saveModelBinary in training.py, all little-endian: a fixed header
+# of the magic, format version, number of support vectors, number of features, model name and the float64 scalars,
+# followed by the mean, std, dual coefficient and row-major support vector arrays as float64. Every array starts at
+# a multiple of 8 bytes, so it can be memory-mapped in place.
+MODEL_MAGIC = b'CSVM'
+MODEL_VERSION = 1
+MODEL_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('supportVectors', '<u4'), ('features', '<u4'),
+                         ('modelName', 'S16'), ('intercept', '<f8'), ('gamma', '<f8'), ('probA', '<f8'),
+                         ('probB', '<f8'), ('bias', '<f8', 2)])
+
+
+def loadModelBinary(filename):
+    """Load a binary model, memory-mapping its arrays rather than reading them."""
+    header = np.fromfile(filename, dtype=MODEL_HEADER, count=1)[0]
+    if header['magic'] != MODEL_MAGIC or header['version'] != MODEL_VERSION:
+        raise ValueError('Not a version %d binary model: %s' % (MODEL_VERSION, filename))
+
+    n, d = int(header['supportVectors']), int(header['features'])
+    arrays = np.memmap(filename, dtype='<f8', mode='r', offset=MODEL_HEADER.itemsize, shape=(2 * d + n + n * d,))
+    return SVMModel(arrays[2 * d + n:].reshape(n, d), arrays[2 * d:2 * d + n],
+                    header['intercept'], header['gamma'], header['probA'], header['probB'],
+                    arrays[:d], arrays[d:2 * d], header['bias'].tolist())
+
+
+def loadModelJSON(filename):
+    with open(filename) as f:
+        model = json.load(f)
+
+    gamma = [param['value'] for param in model['kernel']['parameters'] if param['name'] == 'gamma'][0]
+    return SVMModel([support['supportVector'] for support in model['support']],
+                    [support['dualCoef'] for support in model['support']],
+                    model['intercept'], gamma, model['probA'], model['probB'],
+                    [param['mean'] for param in model['normparams']],
+                    [param['std'] for param in model['normparams']],
+                    model['bias'])
+
+
+def loadModel(filename):
+    """Load a model written by saveModel or saveModelBinary, telling the formats apart by the magic bytes."""
+    with open(filename, 'rb') as f:
+        magic = f.read(len(MODEL_MAGIC))
+
+    if magic == MODEL_MAGIC:
+        return loadModelBinary(filename)
+    return loadModelJSON(filename)
+
+
+def readFeatureBlocks(filename, rows):
+    """Yield (timestamps, features) blocks of at most rows lines from a feature vector file."""
+    with open(filename, 'rb') as f:
+        while True:
+            lines = [line.strip() for line in itertools.islice(f, rows)]
+            lines = [line for line in lines if line]
+            if not lines:
+                return
+
+            block = np.fromstring(b','.join(lines), dtype=np.float64, sep=',').reshape(len(lines), -1)
+            yield block[:, 0].astype(np.int64), block[:, 1:]
+
+
+def scoreFile(model, featureFile, output, memory_mb=256):
+    """Score every window of featureFile into output, one block of at most memory_mb at a time."""
+    rows = model.block_rows(memory_mb)
+    with open(output, 'w') as f:
+        for timestamps, features in readFeatureBlocks(featureFile, rows):
+            probs = model.predict_proba(features, memory_mb)
+            np.savetxt(f, np.column_stack([timestamps, probs, model.label(probs)]), fmt='%d,%.17g,%d')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    scoreFile(loadModel(args.model), args.featureFile, args.output, args.memoryMB)
@@ -25,19 +25,21 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
-import json
-from collections import Sized
+import bisect
+import sys
 from pprint import pprint
 
 import numpy as np
 from pathlib import Path
 from sklearn import svm, metrics, preprocessing
-from sklearn.base import clone, is_classifier
 from sklearn.cross_validation import LabelKFold
-from sklearn.cross_validation import check_cv
 from sklearn.externals.joblib import Parallel, delayed
-from sklearn.grid_search import GridSearchCV, RandomizedSearchCV, ParameterSampler, ParameterGrid
-from sklearn.utils.validation import _num_samples, indexable
+
+from training import (ModifiedBayesSearchCV, ModifiedGridSearchCV, ModifiedHalvingSearchCV, ModifiedRandomizedSearchCV,
+                      ModifiedRefineSearchCV, MultiScorer, NystroemSVC, ReducedSVC, Twobias_scorer_CV, WorkQueue,
+                      compressed_size, cross_val_probs, cross_val_probs_compressed, f1Bias_scorer_CV, parseCSVBlock,
+                      platt_probability, platt_scaling, prune_param_grid, readCached, saveModel, saveModelBinary,
+                      writeFeatureStore)
 
 # Command line parameter configuration
 
@@ -47,203 +49,144 @@ parser.add_argument('--featureFolder', dest='featureFolder', required=True,
 parser.add_argument('--scorer', type=str, required=True, dest='scorer',
                     help='Specify which scorer function to use (f1 or twobias)')
 parser.add_argument('--whichsearch', type=str, required=True, dest='whichsearch',
-                    help='Specify which search function to use (GridSearch or RandomizedSearch')
+                    help='Specify which search function to use (grid, halving, refine, bayes or RandomizedSearch)')
+parser.add_argument('--alsoScore', type=str, nargs='+', required=False, choices=['f1', 'twobias'],
+                    dest='alsoScore', help='Also rank candidates by these scorers, from the same out-of-fold runs')
 parser.add_argument('--n_iter', type=int, required=False, dest='n_iter',
-                    help='If Randomized Search is used, how many iterations to use')
+                    help='If Randomized Search or bayes search is used, how many candidates to evaluate')
+parser.add_argument('--keepProbs', type=int, required=False, default=1, dest='keepProbs',
+                    help='Keep the out-of-fold probabilities of this many top candidates; 0 refits the folds')
+parser.add_argument('--factor', type=int, required=False, default=3, dest='factor',
+                    help='If halving search is used, keep 1/factor of the candidates and grow the folds by factor')
+parser.add_argument('--minFolds', type=int, required=False, default=2, dest='minFolds',
+                    help='If halving search is used, number of subject folds in the first round')
+parser.add_argument('--coarseStep', type=float, required=False, default=2.0, dest='coarseStep',
+                    help='If refine search is used, log2 spacing of the initial C/gamma lattice')
+parser.add_argument('--finalStep', type=float, required=False, default=0.5, dest='finalStep',
+                    help='If refine search is used, log2 spacing at which refinement stops')
+parser.add_argument('--topK', type=int, required=False, default=5, dest='topK',
+                    help='If refine search is used, number of best candidates refined in each round')
+parser.add_argument('--nInitial', type=int, required=False, default=20, dest='nInitial',
+                    help='If bayes search is used, number of random candidates before the surrogate is fitted')
+parser.add_argument('--patience', type=int, required=False, default=3, dest='patience',
+                    help='If bayes search is used, stop after this many rounds without improvement')
+parser.add_argument('--decisionScores', action='store_true', dest='decisionScores',
+                    help='Fit with probability=False and rank on decision function values, calibrating the final '
+                         'model once')
+parser.add_argument('--maxIter', type=int, required=False, default=-1, dest='maxIter',
+                    help='Solver iterations a fit may take before its candidate is marked failed (-1: no limit)')
+parser.add_argument('--workQueue', type=str, required=False, dest='workQueue',
+                    help='Directory shared with worker processes, which then run the (candidate, fold) fits')
+parser.add_argument('--worker', action='store_true', dest='worker',
+                    help='Serve the --workQueue of a search instead of searching; run with the same arguments')
+parser.add_argument('--taskTimeout', type=float, required=False, default=600, dest='taskTimeout',
+                    help='Seconds without a heartbeat after which a claimed --workQueue task is handed out again, and '
+                         'without any progress after which the search gives up')
+parser.add_argument('--fitTimeout', type=float, required=False, dest='fitTimeout',
+                    help='Seconds after which a fit is killed, its candidate marked failed and its other folds '
+                         'skipped; each fit then runs in a child process')
+parser.add_argument('--approx', action='store_true', dest='approx',
+                    help='Train a linear model on a Nystroem approximation of the RBF kernel of each gamma, ranking on '
+                         'decision function values as with --decisionScores')
+parser.add_argument('--approxComponents', type=int, required=False, default=500, dest='approxComponents',
+                    help='If --approx is used, number of training windows the kernel approximation is built on')
+parser.add_argument('--approxLoss', type=str, required=False, default='squared_hinge',
+                    choices=['squared_hinge', 'hinge', 'logistic'], dest='approxLoss',
+                    help='If --approx is used, train a linear SVM with this loss or a logistic regression')
+parser.add_argument('--precomputeKernel', action='store_true', dest='precomputeKernel',
+                    help='Compute each RBF kernel matrix once per gamma and share it across C and class_weight')
+parser.add_argument('--kernelCacheMB', type=int, required=False, dest='kernelCacheMB',
+                    help='Memory budget in megabytes for the kernel matrices computed with --precomputeKernel and '
+                         'the fold slices of them that the local workers fit on (default: half the physical memory)')
+parser.add_argument('--memmapFolder', type=str, required=False, dest='memmapFolder',
+                    help='Directory where the training matrix is memory-mapped once and shared with all workers')
+parser.add_argument('--foldParallel', action='store_true', dest='foldParallel',
+                    help='Schedule every (candidate, fold) pair as its own task instead of one task per candidate')
+parser.add_argument('--resultStore', type=str, required=False, dest='resultStore',
+                    help='SQLite file recording every evaluated candidate, so an interrupted search can resume')
 parser.add_argument('--modelOutput', type=str, required=True, dest='modelOutput',
                     help='Model file to write')
+parser.add_argument('--modelBinary', type=str, required=False, dest='modelBinary',
+                    help='Also write the model in the memory-mappable binary format to this file')
+parser.add_argument('--compress', type=float, nargs='+', required=False, dest='compress',
+                    help='Report the out-of-fold score of the model compressed to fewer vectors by these factors')
+parser.add_argument('--compressedOutput', type=str, required=False, dest='compressedOutput',
+                    help='Write the model compressed by the first --compress factor to this file')
 parser.add_argument('--featureFile', type=str, required=True, dest='featureFile',
                     help='Feature vector file name')
 parser.add_argument('--puffGroundtruth', type=str, required=True, dest='puffGroundtruth',
                     help='puffMarker ground truth filename')
+parser.add_argument('--streamFolder', type=str, required=False, dest='streamFolder',
+                    help='Label and normalize the features file by file into a disk-backed store in this directory')
+parser.add_argument('--chunkSize', type=int, required=False, default=100000, dest='chunkSize',
+                    help='Rows per chunk when streaming features into --streamFolder')
+parser.add_argument('--cacheFolder', type=str, required=False, dest='cacheFolder',
+                    help='Directory for parsed copies of the input files, refreshed when a file changes')
+parser.add_argument('--crossParticipant', action='store_true', dest='crossParticipant',
+                    help='Match windows against puffs and episodes of any participant, as earlier versions did')
 args = parser.parse_args()
 
 
-def cv_fit_and_score(estimator, X, y, scorer, parameters, cv, ):
-    """Fit estimator and compute scores for a given dataset split.
-    Parameters
-    ----------
-    estimator : estimator object implementing 'fit'
-        The object to use to fit the data.
-    X : array-like of shape at least 2D
-        The data to fit.
-    y : array-like, optional, default: None
-        The target variable to try to predict in the case of
-        supervised learning.
-    scorer : callable
-        A scorer callable object / function with signature
-        ``scorer(estimator, X, y)``.
-    parameters : dict or None
-        Parameters to be set on the estimator.
-    cv:	Cross-validation fold indeces
-    Returns
-    -------
-    score : float
-        CV score on whole set.
-    parameters : dict or None, optional
-        The parameters that have been evaluated.
-    """
-    estimator.set_params(**parameters)
-    cv_probs_ = cross_val_probs(estimator, X, y, cv)
-    score = scorer(cv_probs_, y)
-
-    return [score, parameters]  # scoring_time]
-
-
-class ModifiedGridSearchCV(GridSearchCV):
-    def __init__(self, estimator, param_grid, scoring=None, fit_params=None,
-                 n_jobs=1, iid=True, refit=True, cv=None, verbose=0,
-                 pre_dispatch='2*n_jobs', error_score='raise'):
-
-        super(ModifiedGridSearchCV, self).__init__(
-            estimator, param_grid, scoring, fit_params, n_jobs, iid,
-            refit, cv, verbose, pre_dispatch, error_score)
-
-    def fit(self, X, y):
-        """Actual fitting,  performing the search over parameters."""
-
-        parameter_iterable = ParameterGrid(self.param_grid)
-
-        estimator = self.estimator
-        cv = self.cv
-
-        n_samples = _num_samples(X)
-        X, y = indexable(X, y)
-
-        if y is not None:
-            if len(y) != n_samples:
-                raise ValueError('Target variable (y) has a different number '
-                                 'of samples (%i) than data (X: %i samples)'
-                                 % (len(y), n_samples))
-        cv = check_cv(cv, X, y, classifier=is_classifier(estimator))
-
-        if self.verbose > 0:
-            if isinstance(parameter_iterable, Sized):
-                n_candidates = len(parameter_iterable)
-                print("Fitting {0} folds for each of {1} candidates, totalling"
-                      " {2} fits".format(len(cv), n_candidates,
-                                         n_candidates * len(cv)))
-
-        base_estimator = clone(self.estimator)
-
-        pre_dispatch = self.pre_dispatch
-
-        out = Parallel(
-            n_jobs=self.n_jobs, verbose=self.verbose,
-            pre_dispatch=pre_dispatch
-        )(
-            delayed(cv_fit_and_score)(clone(base_estimator), X, y, self.scoring,
-                                      parameters, cv=cv)
-            for parameters in parameter_iterable)
-
-        best = sorted(out, reverse=True)[0]
-        self.best_params_ = best[1]
-        self.best_score_ = best[0]
-
-        if self.refit:
-            # fit the best estimator using the entire dataset
-            # clone first to work around broken estimators
-            best_estimator = clone(base_estimator).set_params(
-                **best[1])
-            if y is not None:
-                best_estimator.fit(X, y, **self.fit_params)
-            else:
-                best_estimator.fit(X, **self.fit_params)
-            self.best_estimator_ = best_estimator
-
-        return self
-
-
-class ModifiedRandomizedSearchCV(RandomizedSearchCV):
-    def __init__(self, estimator, param_distributions, n_iter=10, scoring=None,
-                 fit_params=None, n_jobs=1, iid=True, refit=True, cv=None,
-                 verbose=0, pre_dispatch='2*n_jobs', random_state=None,
-                 error_score='raise'):
-
-        super(ModifiedRandomizedSearchCV, self).__init__(estimator=estimator, param_distributions=param_distributions,
-                                                         n_iter=n_iter, scoring=scoring, random_state=random_state,
-                                                         fit_params=fit_params, n_jobs=n_jobs, iid=iid, refit=refit,
-                                                         cv=cv, verbose=verbose, pre_dispatch=pre_dispatch,
-                                                         error_score=error_score)
-
-    def fit(self, X, y):
-        """Actual fitting,  performing the search over parameters."""
-
-        parameter_iterable = ParameterSampler(self.param_distributions,
-                                              self.n_iter,
-                                              random_state=self.random_state)
-        estimator = self.estimator
-        cv = self.cv
-
-        n_samples = _num_samples(X)
-        X, y = indexable(X, y)
-
-        if y is not None:
-            if len(y) != n_samples:
-                raise ValueError('Target variable (y) has a different number '
-                                 'of samples (%i) than data (X: %i samples)'
-                                 % (len(y), n_samples))
-        cv = check_cv(cv, X, y, classifier=is_classifier(estimator))
-
-        if self.verbose > 0:
-            if isinstance(parameter_iterable, Sized):
-                n_candidates = len(parameter_iterable)
-                print("Fitting {0} folds for each of {1} candidates, totalling"
-                      " {2} fits".format(len(cv), n_candidates,
-                                         n_candidates * len(cv)))
-
-        base_estimator = clone(self.estimator)
-
-        pre_dispatch = self.pre_dispatch
-
-        out = Parallel(
-            n_jobs=self.n_jobs, verbose=self.verbose,
-            pre_dispatch=pre_dispatch
-        )(
-            delayed(cv_fit_and_score)(clone(base_estimator), X, y, self.scoring,
-                                      parameters, cv=cv)
-            for parameters in parameter_iterable)
-
-        best = sorted(out, reverse=True)[0]
-        self.best_params_ = best[1]
-        self.best_score_ = best[0]
-
-        if self.refit:
-            # fit the best estimator using the entire dataset
-            # clone first to work around broken estimators
-            best_estimator = clone(base_estimator).set_params(
-                **best[1])
-            if y is not None:
-                best_estimator.fit(X, y, **self.fit_params)
-            else:
-                best_estimator.fit(X, **self.fit_params)
-            self.best_estimator_ = best_estimator
-
-        return self
-
-
-def readFeatures(folder, filename):
-    features = []
+def parseFeatureFile(f):
+    block = parseCSVBlock(f)
+
+    timestamps = block[:, 0].astype(np.int64)
+    return {'timestamps': timestamps, 'endtimes': timestamps + block[:, 24].astype(np.int64),
+            'features': np.ascontiguousarray(block[:, 1:])}
+
+
+def readFeatureFile(filename, cacheFolder=None):
+    return readCached(Path(filename), parseFeatureFile, cacheFolder)
+
 
+def readFeatureMatrix(folder, filename, cacheFolder=None, n_jobs=1):
+    """Read every feature file under folder into arrays of participant IDs, window start and end times and
+    features.
+
+    Files are parsed in parallel, each straight into a NumPy block, and the blocks are concatenated into one
+    contiguous float64 feature matrix.
+    """
     path = Path(folder)
     files = list(path.glob('p*/s*/' + filename))
 
-    for f in files:
-        participantID = int(f.parent.parent.name[1:])
-        # if participantID > 2:
-        with f.open() as file:
-            for line in file.readlines():
-                parts = [x.strip() for x in line.split(',')]
+    blocks = Parallel(n_jobs=n_jobs)(delayed(readFeatureFile)(str(f), cacheFolder) for f in files)
+    blocks = [(int(f.parent.parent.name[1:]), data) for f, data in zip(files, blocks) if len(data['timestamps']) > 0]
+    if not blocks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 0))
+
+    participants = np.concatenate([np.repeat(participantID, len(data['timestamps'])) for participantID, data in blocks])
+    starttimes = np.concatenate([data['timestamps'] for participantID, data in blocks])
+    endtimes = np.concatenate([data['endtimes'] for participantID, data in blocks])
+    features = np.concatenate([data['features'] for participantID, data in blocks])
 
-                featureVector = [participantID, int(parts[0]), int(parts[0]) + int(float(parts[24]))]
-                featureVector.extend([float(p) for p in parts[1:]])
+    return participants, starttimes, endtimes, features
 
-                features.append(featureVector)
+
+def readFeatures(folder, filename, cacheFolder=None):
+    features = []
+
+    participants, starttimes, endtimes, values = readFeatureMatrix(folder, filename, cacheFolder)
+    for participantID, starttime, endtime, featureValues in zip(participants.tolist(), starttimes.tolist(),
+                                                                endtimes.tolist(), values.tolist()):
+        featureVector = [participantID, starttime, endtime]
+        featureVector.extend(featureValues)
+
+        features.append(featureVector)
 
     return features
 
 
-def readPuffMarkerGroundtruth(folder, filename):
+def parsePuffMarkerGroundtruthFile(f):
+    timestamps = []
+    with f.open() as file:
+        for line in file.readlines():
+            parts = [x.strip() for x in line.split(',')]
+            timestamps.append(int(float(parts[0])))
+
+    return {'timestamps': np.array(timestamps, dtype=np.int64)}
+
+
+def readPuffMarkerGroundtruth(folder, filename, cacheFolder=None):
     features = []
 
     path = Path(folder)
@@ -251,18 +194,28 @@ def readPuffMarkerGroundtruth(folder, filename):
 
     for f in files:
         participantID = int(f.parent.parent.name[1:])
+        data = readCached(f, parsePuffMarkerGroundtruthFile, cacheFolder)
 
-        with f.open() as file:
-            for line in file.readlines():
-                parts = [x.strip() for x in line.split(',')]
-                features.append([participantID, int(float(parts[0]))])
+        for puffTS in data['timestamps'].tolist():
+            features.append([participantID, puffTS])
 
     return features
 
 
-def readSmokingEpisodeStartEndTIme(folder, filename):
-    epiStartTime = []
-    epiEndTime = []
+def parseSmokingEpisodeFile(f):
+    starts = []
+    ends = []
+    with f.open() as file:
+        for line in file.readlines():
+            parts = [x.strip() for x in line.split(',')]
+            starts.append(int(float(parts[0])))
+            ends.append(int(float(parts[1])))
+
+    return {'starts': np.array(starts, dtype=np.int64), 'ends': np.array(ends, dtype=np.int64)}
+
+
+def readSmokingEpisodes(folder, filename, cacheFolder=None):
+    episodes = []
 
     path = Path(folder)
     files = list(path.glob('p*/s*/' + filename))
@@ -270,257 +223,174 @@ def readSmokingEpisodeStartEndTIme(folder, filename):
     for f in files:
         participantID = int(f.parent.parent.name[1:])
 
-        with f.open() as file:
-            for line in file.readlines():
-                parts = [x.strip() for x in line.split(',')]
-                epiStartTime.append(int(float(parts[0])));
-                epiEndTime.append(int(float(parts[1])));
-                # features.append([participantID, int(float(parts[0]))])
-
-    return epiStartTime, epiEndTime
+        data = readCached(f, parseSmokingEpisodeFile, cacheFolder)
+        for start, end in zip(data['starts'].tolist(), data['ends'].tolist()):
+            episodes.append([participantID, start, end])
 
+    return episodes
 
-# analyze_events_with_features_filter_episode(features, groundtruth, epiStartTime, epiEndTime)
 
-def analyze_events_with_features_filter_episode(features, puff_marks, epiStartTime, epiEndTime):
-    featureLabels = []
-    finalFeatures = []
-    subjects = []
-    cnt01 = 0;
+def readSmokingEpisodeStartEndTIme(folder, filename, cacheFolder=None):
+    episodes = readSmokingEpisodes(folder, filename, cacheFolder)
 
-    for line in features:
-        id = line[0]
-        starttime = line[1]
-        endtime = line[2]
-        f = line[3:]
+    epiStartTime = [start for participantID, start, end in episodes]
+    epiEndTime = [end for participantID, start, end in episodes]
 
-        found = 0
-        for puffID, puffTS in puff_marks:
-            if puffTS >= starttime and puffTS <= endtime:
-                found = 1
-                break
-
-        if found == 0:
-            inside = 0
-            for i in range(0, len(epiStartTime)):
-                if starttime >= epiStartTime[i] and starttime <= epiEndTime[i]:
-                    inside = 1
-                    break
-            if inside == 1:
-                continue
-
-        cnt01 = cnt01 + 1
-        featureLabels.append(found)
-        finalFeatures.append(f)
-        subjects.append(id)
-
-    cnt01
-    return finalFeatures, featureLabels, subjects
-
-def analyze_events_with_features(features, puff_marks):
-    featureLabels = []
-    finalFeatures = []
-    subjects = []
-
-    for line in features:
-        id = line[0]
-        starttime = line[1]
-        endtime = line[2]
-        f = line[3:]
-
-        found = 0
-        for puffID, puffTS in puff_marks:
-            if puffTS >= starttime and puffTS <= endtime:
-                found = 1
-                break
-
-        featureLabels.append(found)
-        finalFeatures.append(f)
-        subjects.append(id)
-
-    return finalFeatures, featureLabels, subjects
+    return epiStartTime, epiEndTime
 
 
-def get_svmdataset(traindata, trainlabels):
-    input = []
-    output = []
-    foldinds = []
+class PuffIndex(object):
+    """Sorted puff timestamps per participant, answering "is there a puff in [starttime, endtime]" by bisection.
 
-    for i in range(len(trainlabels)):
-        if trainlabels[i] == 1:
-            foldinds.append(i)
+    With cross_participant=True all puffs share one list, which reproduces the earlier labeling that matched
+    puffs of any participant.
+    """
 
-        if trainlabels[i] == 0:
-            foldinds.append(i)
+    def __init__(self, puff_marks, cross_participant=False):
+        self.cross_participant = cross_participant
 
-    input = np.array(input, dtype='float64')
-    return output, input, foldinds
+        times = {}
+        for puffID, puffTS in puff_marks:
+            times.setdefault(None if cross_participant else puffID, []).append(puffTS)
+        self.times = dict((pid, np.sort(np.asarray(ts, dtype=np.int64))) for pid, ts in times.items())
 
+    def found(self, pid, starttime, endtime):
+        times = self.times.get(None if self.cross_participant else pid, [])
+        i = bisect.bisect_left(times, starttime)
+        if i < len(times) and times[i] <= endtime:
+            return 1
+        return 0
 
-def reduceData(data, r):
-    result = []
-    for d in data:
-        result.append([d[i] for i in r])
-    return result
+    def found_many(self, pids, starttimes, endtimes):
+        """found() for arrays of windows, with one searchsorted pass per participant."""
+        pids = np.asarray(pids)
+        starttimes = np.asarray(starttimes, dtype=np.int64)
+        endtimes = np.asarray(endtimes, dtype=np.int64)
+        found = np.zeros(len(starttimes), dtype=np.int64)
 
+        for pid, times in self.times.items():
+            rows = np.arange(len(starttimes)) if self.cross_participant else np.where(pids == pid)[0]
+            i = np.searchsorted(times, starttimes[rows], side='left')
+            found[rows] = (i < len(times)) & (times[np.minimum(i, len(times) - 1)] <= endtimes[rows])
 
-def f1Bias_scorer(estimator, X, y, ret_bias=False):
-    probas_ = estimator.predict_proba(X)
-    precision, recall, thresholds = metrics.precision_recall_curve(y, probas_[:, 1])
+        return found
 
-    f1 = 0.0
-    for i in range(0, len(thresholds)):
-        if not (precision[i] == 0 and recall[i] == 0):
-            f = 2 * (precision[i] * recall[i]) / (precision[i] + recall[i])
-            if f > f1:
-                f1 = f
-                bias = thresholds[i]
 
-    if ret_bias:
-        return f1, bias
-    else:
-        return f1
+class EpisodeIndex(object):
+    """Smoking episodes per participant as sorted, merged [start, end] intervals.
 
+    Overlapping or touching episodes are merged, so a time lies inside an episode exactly when it is not past
+    the end of the last interval starting at or before it: one bisection per time, or one searchsorted pass
+    for a whole array of times. With cross_participant=True all episodes are pooled, as earlier versions did.
+    """
 
-def Twobias_scorer_CV(probs, y, ret_bias=False):
-    db = np.transpose(np.vstack([probs, y]))
-    db = db[np.argsort(db[:, 0]), :]
+    def __init__(self, episodes, cross_participant=False):
+        self.cross_participant = cross_participant
 
-    pos = np.sum(y == 1)
-    n = len(y)
-    neg = n - pos
-    tp, tn = pos, 0
-    lost = 0
+        grouped = {}
+        for pid, start, end in episodes:
+            if start <= end:
+                grouped.setdefault(None if cross_participant else pid, []).append((start, end))
 
-    optbias = []
-    minloss = 1
+        self.intervals = {}
+        for pid, intervals in grouped.items():
+            merged = []
+            for start, end in sorted(intervals):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            merged = np.array(merged, dtype=np.int64)
+            self.intervals[pid] = (merged[:, 0], merged[:, 1])
 
-    for i in range(n):
-        #		p = db[i,1]
-        if db[i, 1] == 1:  # positive
-            tp -= 1.0
-        else:
-            tn += 1.0
+    def inside(self, pid, time):
+        starts, ends = self.intervals.get(None if self.cross_participant else pid, ([], []))
+        i = bisect.bisect_right(starts, time) - 1
+        return i >= 0 and time <= ends[i]
 
-        # v1 = tp/pos
-        #		v2 = tn/neg
-        if tp / pos >= 0.95 and tn / neg >= 0.95:
-            optbias = [db[i, 0], db[i, 0]]
-            continue
+    def inside_many(self, pids, times):
+        """Boolean mask of which (pid, time) pairs fall inside an episode."""
+        pids = np.asarray(pids)
+        times = np.asarray(times, dtype=np.int64)
+        mask = np.zeros(len(times), dtype=bool)
 
-        running_pos = pos
-        running_neg = neg
-        running_tp = tp
-        running_tn = tn
+        for pid, (starts, ends) in self.intervals.items():
+            rows = np.arange(len(times)) if self.cross_participant else np.where(pids == pid)[0]
+            i = np.searchsorted(starts, times[rows], side='right') - 1
+            mask[rows] = (i >= 0) & (times[rows] <= ends[np.maximum(i, 0)])
 
-        for j in range(i + 1, n):
-            #			p1 = db[j,1]
-            if db[j, 1] == 1:  # positive
-                running_tp -= 1.0
-                running_pos -= 1
-            else:
-                running_neg -= 1
+        return mask
 
-            lost = (j - i) * 1.0 / n
-            if running_pos == 0 or running_neg == 0:
-                break
 
-            # v1 = running_tp/running_pos
-            #			v2 = running_tn/running_neg
+def analyze_feature_matrix_filter_episode(participants, starttimes, endtimes, features, puff_marks, episodes,
+                                          cross_participant=False):
+    """Array version of analyze_events_with_features_filter_episode."""
+    featureLabels = PuffIndex(puff_marks, cross_participant).found_many(participants, starttimes, endtimes)
+    inside = EpisodeIndex(episodes, cross_participant).inside_many(participants, starttimes)
 
-            if running_tp / running_pos >= 0.95 and running_tn / running_neg >= 0.95 and lost < minloss:
-                minloss = lost
-                optbias = [db[i, 0], db[j, 0]]
+    rows = np.where((featureLabels == 1) | ~inside)[0]
+    return features[rows], featureLabels[rows], participants[rows]
 
-    if ret_bias:
-        return -minloss, optbias
-    else:
-        return -minloss
 
+def analyze_feature_matrix(participants, starttimes, endtimes, features, puff_marks, cross_participant=False):
+    """Array version of analyze_events_with_features."""
+    featureLabels = PuffIndex(puff_marks, cross_participant).found_many(participants, starttimes, endtimes)
 
-def f1Bias_scorer_CV(probs, y, ret_bias=False):
-    precision, recall, thresholds = metrics.precision_recall_curve(y, probs)
+    return features, featureLabels, participants
 
-    f1 = 0.0
-    for i in range(0, len(thresholds)):
-        if not (precision[i] == 0 and recall[i] == 0):
-            f = 2 * (precision[i] * recall[i]) / (precision[i] + recall[i])
-            if f > f1:
-                f1 = f
-                bias = thresholds[i]
 
-    if ret_bias:
-        return f1, bias
-    else:
-        return f1
+def splitFeatures(features):
+    participants = np.array([line[0] for line in features], dtype=np.int64)
+    starttimes = np.array([line[1] for line in features], dtype=np.int64)
+    endtimes = np.array([line[2] for line in features], dtype=np.int64)
+    values = np.array([line[3:] for line in features], dtype=np.float64)
 
+    return participants, starttimes, endtimes, values
 
-def svmOutput(filename, traindata, trainlabels):
-    with open(filename, 'w') as f:
-        for i in range(0, len(trainlabels)):
-            f.write(str(trainlabels[i]))
-            for fi in range(0, len(traindata[i])):
-                f.write(" " + str(fi + 1) + ":" + str(traindata[i][fi]))
 
-            f.write("\n")
+# analyze_events_with_features_filter_episode(features, groundtruth, episodes)
 
+def analyze_events_with_features_filter_episode(features, puff_marks, episodes, cross_participant=False):
+    participants, starttimes, endtimes, values = splitFeatures(features)
 
-def saveModel(filename, model, normparams, bias=0.5):
-    class Object:
-        def to_JSON(self):
-            return json.dumps(self, default=lambda o: o.__dict__,
-                              sort_keys=True, indent=4)
+    finalFeatures, featureLabels, subjects = analyze_feature_matrix_filter_episode(
+        participants, starttimes, endtimes, values, puff_marks, episodes, cross_participant)
 
-    class Kernel(Object):
-        def __init__(self, type, parameters):
-            self.type = type
-            self.parameters = parameters
+    return finalFeatures.tolist(), featureLabels.tolist(), subjects.tolist()
 
-    class KernelParam(Object):
-        def __init__(self, name, value):
-            self.name = name;
-            self.value = value
 
-    class Support(Object):
-        def __init__(self, dualCoef, supportVector):
-            self.dualCoef = dualCoef
-            self.supportVector = supportVector
+def analyze_events_with_features(features, puff_marks, cross_participant=False):
+    participants, starttimes, endtimes, values = splitFeatures(features)
 
-    class NormParam(Object):
-        def __init__(self, mean, std):
-            self.mean = mean
-            self.std = std
+    finalFeatures, featureLabels, subjects = analyze_feature_matrix(participants, starttimes, endtimes, values,
+                                                                    puff_marks, cross_participant)
 
-    class SVCModel(Object):
-        def __init__(self, modelName, modelType, intercept, bias, probA, probB, kernel, support, normparams):
-            self.modelName = modelName;
-            self.modelType = modelType;
-            self.intercept = intercept;
-            self.bias = bias;
-            self.probA = probA;
-            self.probB = probB;
-            self.kernel = kernel
-            self.support = support
-            self.normparams = normparams
+    return finalFeatures.tolist(), featureLabels.tolist(), subjects.tolist()
 
-    model = SVCModel('puffMarker', 'svc', model.intercept_[0], bias, model.probA_[0], model.probB_[0],
-                     Kernel('rbf', [KernelParam('gamma', model._gamma)]),
-                     [Support(model.dual_coef_[0][i], list(model.support_vectors_[i])) for i in
-                      range(len(model.dual_coef_[0]))],
-                     [NormParam(normparams.mean_[i], normparams.scale_[i]) for i in range(len(normparams.scale_))])
 
-    with open(filename, 'w') as f:
-        print >> f, model.to_JSON()
+def iterLabeledChunks(folder, filename, puff_marks, episodes, chunk_size=100000, cacheFolder=None,
+                      cross_participant=False):
+    """Yield (features, labels, participants) chunks of at most chunk_size labeled windows.
 
+    Feature files are read and labeled one at a time, so memory is bounded by the largest file rather than
+    by the whole feature folder.
+    """
+    puffIndex = PuffIndex(puff_marks, cross_participant)
+    episodeIndex = EpisodeIndex(episodes, cross_participant)
 
-def cross_val_probs(estimator, X, y, cv):
-    probs = np.zeros(len(y))
+    for f in sorted(Path(folder).glob('p*/s*/' + filename)):
+        data = readFeatureFile(str(f), cacheFolder)
+        if len(data['timestamps']) == 0:
+            continue
 
-    for train, test in cv:
-        temp = estimator.fit(X[train], y[train]).predict_proba(X[test])
-        probs[test] = temp[:, 1]
+        participants = np.repeat(int(f.parent.parent.name[1:]), len(data['timestamps']))
+        featureLabels = puffIndex.found_many(participants, data['timestamps'], data['endtimes'])
+        inside = episodeIndex.inside_many(participants, data['timestamps'])
 
-    return probs
+        rows = np.where((featureLabels == 1) | ~inside)[0]
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            yield data['features'][chunk], featureLabels[chunk], participants[chunk]
 
 
 def writeToFile(traindatas, trainlabels):
@@ -538,22 +408,35 @@ def writeToFile(traindatas, trainlabels):
 # This tool accepts the data produced by the Java cStress implementation and trains and evaluates an SVM model with
 # cross-subject validation
 if __name__ == '__main__':
-    features = readFeatures(args.featureFolder, args.featureFile)
-    groundtruth = readPuffMarkerGroundtruth(args.featureFolder, args.puffGroundtruth)
+    if args.worker:
+        WorkQueue(args.workQueue, args.taskTimeout).serve()
+        sys.exit()
+
+    groundtruth = readPuffMarkerGroundtruth(args.featureFolder, args.puffGroundtruth, args.cacheFolder)
 
-    epiStartTime, epiEndTime = readSmokingEpisodeStartEndTIme(args.featureFolder, '*episode_start_end.csv')
+    episodes = readSmokingEpisodes(args.featureFolder, '*episode_start_end.csv', args.cacheFolder)
 
-    # traindata, trainlabels, subjects = analyze_events_with_features(features, groundtruth)
-    traindata, trainlabels, subjects = analyze_events_with_features_filter_episode(features, groundtruth, epiStartTime,
-                                                                                   epiEndTime)
+    if args.streamFolder:
+        chunks = iterLabeledChunks(args.featureFolder, args.featureFile, groundtruth, episodes, args.chunkSize,
+                                   args.cacheFolder, args.crossParticipant)
+        traindata, trainlabels, subjects, normalizer = writeFeatureStore(chunks, args.streamFolder, args.chunkSize)
+    else:
+        participants, starttimes, endtimes, features = readFeatureMatrix(args.featureFolder, args.featureFile,
+                                                                         args.cacheFolder, n_jobs=-1)
+
+        # traindata, trainlabels, subjects = analyze_feature_matrix(participants, starttimes, endtimes, features,
+        #                                                           groundtruth, args.crossParticipant)
+        traindata, trainlabels, subjects = analyze_feature_matrix_filter_episode(participants, starttimes, endtimes,
+                                                                                 features, groundtruth, episodes,
+                                                                                 args.crossParticipant)
 
-    writeToFile(traindata, trainlabels)
+        writeToFile(traindata, trainlabels)
 
-    traindata = np.asarray(traindata, dtype=np.float64)
-    trainlabels = np.asarray(trainlabels)
+        traindata = np.asarray(traindata, dtype=np.float64)
+        trainlabels = np.asarray(trainlabels)
 
-    normalizer = preprocessing.StandardScaler()
-    traindata = normalizer.fit_transform(traindata)
+        normalizer = preprocessing.StandardScaler()
+        traindata = normalizer.fit_transform(traindata)
 
     lkf = LabelKFold(subjects, n_folds=len(np.unique(subjects)))
 
@@ -567,20 +450,69 @@ if __name__ == '__main__':
                   'C': [2 ** x for x in np.arange(-12, 12, 0.5)],
                   'gamma': [2 ** x for x in np.arange(-12, 12, 0.5)],
                   'class_weight': [{0: w, 1: 1 - w} for w in np.arange(0.0, 1.0, delta)]}
-
-    svc = svm.SVC(probability=True, verbose=False, cache_size=2000)
+    parameters, degenerate = prune_param_grid(parameters)
+    if degenerate:
+        print "Dropped degenerate class weights:", degenerate
+
+    if args.approx:
+        if args.precomputeKernel:
+            parser.error('--approx does not fit exact kernels, so it cannot be combined with --precomputeKernel')
+        svc = NystroemSVC(n_components=args.approxComponents, loss=args.approxLoss, random_state=0)
+        if args.maxIter > 0:
+            svc.set_params(max_iter=args.maxIter)
+    else:
+        svc = svm.SVC(probability=not args.decisionScores, verbose=False, cache_size=2000,
+                      max_iter=args.maxIter)
 
     # if args.scorer == 'f1':
     #     scorer = f1Bias_scorer_CV
     # else:
     scorer = Twobias_scorer_CV
 
+    search_scorer = scorer
+    if args.alsoScore:
+        # Secondary objectives are scored from the same out-of-fold probabilities, without extra fits
+        search_scorer = MultiScorer([scorer] + [{'f1': f1Bias_scorer_CV, 'twobias': Twobias_scorer_CV}[name]
+                                                for name in args.alsoScore])
+
     if args.whichsearch == 'grid':
-        clf = ModifiedGridSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=scorer, verbose=1, iid=False)
+        clf = ModifiedGridSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=search_scorer, verbose=1, iid=False,
+                                   precompute_kernel=args.precomputeKernel, kernel_cache_mb=args.kernelCacheMB,
+                                   memmap_folder=args.memmapFolder, fold_parallel=args.foldParallel,
+                                   result_store=args.resultStore, keep_probs=args.keepProbs,
+                                   fit_timeout=args.fitTimeout, work_queue=args.workQueue,
+                                   task_timeout=args.taskTimeout)
+    elif args.whichsearch == 'halving':
+        clf = ModifiedHalvingSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=search_scorer, verbose=1, iid=False,
+                                      precompute_kernel=args.precomputeKernel, kernel_cache_mb=args.kernelCacheMB,
+                                      memmap_folder=args.memmapFolder, fold_parallel=args.foldParallel,
+                                      result_store=args.resultStore, keep_probs=args.keepProbs,
+                                      fit_timeout=args.fitTimeout, work_queue=args.workQueue,
+                                      task_timeout=args.taskTimeout, factor=args.factor, min_folds=args.minFolds)
+    elif args.whichsearch == 'refine':
+        clf = ModifiedRefineSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=search_scorer, verbose=1, iid=False,
+                                     precompute_kernel=args.precomputeKernel, kernel_cache_mb=args.kernelCacheMB,
+                                     memmap_folder=args.memmapFolder, fold_parallel=args.foldParallel,
+                                     result_store=args.resultStore, keep_probs=args.keepProbs,
+                                     fit_timeout=args.fitTimeout, work_queue=args.workQueue,
+                                     task_timeout=args.taskTimeout, coarse_step=args.coarseStep,
+                                     final_step=args.finalStep, top_k=args.topK)
+    elif args.whichsearch == 'bayes':
+        clf = ModifiedBayesSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=search_scorer, verbose=1, iid=False,
+                                    precompute_kernel=args.precomputeKernel, kernel_cache_mb=args.kernelCacheMB,
+                                    memmap_folder=args.memmapFolder, fold_parallel=args.foldParallel,
+                                    result_store=args.resultStore, keep_probs=args.keepProbs,
+                                    fit_timeout=args.fitTimeout, work_queue=args.workQueue,
+                                    task_timeout=args.taskTimeout, n_iter=args.n_iter or 200,
+                                    n_initial=args.nInitial, patience=args.patience)
     else:
         clf = ModifiedRandomizedSearchCV(estimator=svc, param_distributions=parameters, cv=lkf, n_jobs=-1,
-                                         scoring=scorer, n_iter=args.n_iter,
-                                         verbose=1, iid=False)
+                                         scoring=search_scorer, n_iter=args.n_iter,
+                                         verbose=1, iid=False, precompute_kernel=args.precomputeKernel,
+                                         kernel_cache_mb=args.kernelCacheMB, memmap_folder=args.memmapFolder,
+                                         fold_parallel=args.foldParallel, result_store=args.resultStore,
+                                         keep_probs=args.keepProbs, fit_timeout=args.fitTimeout,
+                                         work_queue=args.workQueue, task_timeout=args.taskTimeout)
 
     # if args.whichsearch == 'grid':
     #     clf = ModifiedGridSearchCV(svc, parameters, cv=lkf, n_jobs=-1, scoring=scorer, verbose=1, iid=False)
@@ -589,16 +521,45 @@ if __name__ == '__main__':
     #                                      scoring=scorer, n_iter=args.n_iter,
     #                                      verbose=1, iid=False)
 
-    clf.fit(traindata, trainlabels)
+    try:
+        clf.fit(traindata, trainlabels)
+    finally:
+        # Workers exit also when the search fails, instead of polling the queue forever
+        if args.workQueue:
+            WorkQueue(args.workQueue).stop()
     pprint(clf.best_params_)
+    if args.alsoScore:
+        for name in search_scorer.names:
+            print("Best for %s: %f" % (name, clf.leaderboards_[name][0][0]))
+            pprint(clf.best_params_by_scorer_[name])
 
     scorer = f1Bias_scorer_CV
 
-    CV_probs = cross_val_probs(clf.best_estimator_, traindata, trainlabels, lkf)
+    if args.compress:
+        compressed_vectors, compressed_probs = cross_val_probs_compressed(clf.best_estimator_, traindata, trainlabels,
+                                                                          lkf, args.compress, n_jobs=-1)
+        CV_probs = compressed_probs[0]
+    elif args.keepProbs:
+        # The search already has the best candidate's out-of-fold probabilities
+        CV_probs = clf.top_probs_[0][2]
+    else:
+        CV_probs = cross_val_probs(clf.best_estimator_, traindata, trainlabels, lkf, n_jobs=-1)
+
+    if not svc.probability:
+        # CV_probs holds decision function values: calibrate them once and give the refit model the sigmoid
+        probA, probB = platt_scaling(CV_probs, trainlabels)
+        clf.best_estimator_.probA_ = np.array([probA])
+        clf.best_estimator_.probB_ = np.array([probB])
+        CV_probs = platt_probability(CV_probs, probA, probB)
+        if args.compress:
+            compressed_probs = np.array([platt_probability(probs, probA, probB) for probs in compressed_probs])
+
     score, bias = scorer(CV_probs, trainlabels, True)
     print score, bias
     if not bias == []:
-        saveModel(args.modelOutput, clf.best_estimator_, normalizer, bias)
+        saveModel(args.modelOutput, clf.best_estimator_, normalizer, bias, modelName='puffMarker')
+        if args.modelBinary:
+            saveModelBinary(args.modelBinary, clf.best_estimator_, normalizer, bias, modelName='puffMarker')
 
         n = len(trainlabels)
 
@@ -617,3 +578,16 @@ if __name__ == '__main__':
         print("Subjects: " + str(np.unique(subjects)))
     else:
         print "Results not good"
+
+    if args.compress:
+        for factor, vectors, probs in zip(args.compress, compressed_vectors[1:], compressed_probs[1:]):
+            compressed_score, compressed_bias = scorer(probs, trainlabels, True)
+            print("Compressed %gx: %d vectors (%.1fx faster), score %f (%+f), bias %s" %
+                  (factor, vectors, compressed_vectors[0] / vectors, compressed_score, compressed_score - score,
+                   compressed_bias))
+
+        compressed_score, compressed_bias = scorer(compressed_probs[1], trainlabels, True)
+        if args.compressedOutput and not compressed_bias == []:
+            reduced = ReducedSVC(compressed_size(clf.best_estimator_, args.compress[0]))
+            saveModel(args.compressedOutput, reduced.fit(clf.best_estimator_, traindata), normalizer, compressed_bias,
+                      modelName='puffMarker')
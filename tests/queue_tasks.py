@@ -0,0 +1,14 @@
+"""Task functions for test_work_queue, importable by the worker processes it starts."""
+import time
+
+
+def weighted_sum(estimator, X, y, offset):
+    return estimator * float(X.sum()) + float(y.sum()) + offset
+
+
+def slow_echo(estimator, X, y, seconds, log):
+    """Return estimator after seconds, recording each start in the file log."""
+    with open(log, 'a') as f:
+        f.write('%s\n' % estimator)
+    time.sleep(seconds)
+    return estimator
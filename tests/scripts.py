@@ -0,0 +1,18 @@
+"""Importing the training scripts from the tests."""
+import imp
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+
+def load_script(name, extra):
+    """Import a training script, which parses its command line at import time."""
+    argv = sys.argv
+    sys.argv = [name, '--featureFolder', '.', '--scorer', 'f1', '--whichsearch', 'grid',
+                '--modelOutput', 'model.json', '--featureFile', 'features.csv'] + extra
+    try:
+        return imp.load_source(name, os.path.join(ROOT, name + '.py'))
+    finally:
+        sys.argv = argv
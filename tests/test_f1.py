@@ -0,0 +1,71 @@
+"""Equivalence of the batch f1Bias_scorer_CV_batch with f1Bias_scorer_CV applied row by row.
+
+Run from the repository root with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from training import f1Bias_scorer_CV, f1Bias_scorer_CV_batch
+
+
+class F1BatchEquivalenceTest(unittest.TestCase):
+
+    def assertSameAsRows(self, probs, y, block_mb=64):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            scores, biases = f1Bias_scorer_CV_batch(probs, y, True, block_mb)
+            self.assertEqual(len(scores), len(probs))
+            self.assertEqual(len(biases), len(probs))
+            for row, score, bias in zip(probs, scores, biases):
+                expected = f1Bias_scorer_CV(row, y, True)
+                self.assertAlmostEqual(score, expected[0], places=12)
+                if expected[1] == []:
+                    self.assertEqual(bias, [])
+                else:
+                    self.assertEqual(bias, expected[1])
+            np.testing.assert_array_equal(f1Bias_scorer_CV_batch(probs, y, block_mb=block_mb), scores)
+
+    def test_random(self):
+        rs = np.random.RandomState(0)
+        for trial in range(50):
+            n = rs.randint(2, 200)
+            y = (rs.rand(n) < rs.uniform(0.1, 0.9)).astype(int)
+            probs = np.clip(0.4 * y + rs.randn(rs.randint(1, 20), n) * rs.uniform(0.05, 0.6), 0, 1)
+            self.assertSameAsRows(probs, y)
+
+    def test_ties(self):
+        rs = np.random.RandomState(1)
+        for trial in range(50):
+            n = rs.randint(2, 200)
+            y = (rs.rand(n) < 0.5).astype(int)
+            # Few distinct values, so many windows share a probability
+            probs = np.round(np.clip(0.3 * y + rs.rand(rs.randint(1, 20), n) * 0.7, 0, 1), rs.randint(0, 3))
+            self.assertSameAsRows(probs, y)
+
+    def test_no_positives(self):
+        rs = np.random.RandomState(2)
+        for n in (1, 2, 10, 57):
+            self.assertSameAsRows(rs.rand(5, n), np.zeros(n, dtype=int))
+
+    def test_only_positives(self):
+        rs = np.random.RandomState(3)
+        for n in (1, 2, 10, 57):
+            self.assertSameAsRows(rs.rand(5, n), np.ones(n, dtype=int))
+
+    def test_blocks(self):
+        rs = np.random.RandomState(4)
+        n = 300
+        y = (rs.rand(n) < 0.3).astype(int)
+        probs = np.round(np.clip(0.3 * y + rs.rand(37, n) * 0.7, 0, 1), 2)
+        # One row per block, a few rows per block and all rows in one block
+        for block_mb in (1e-6, 0.1, 64):
+            self.assertSameAsRows(probs, y, block_mb)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""fit_failed stopping fits at fit_timeout in a child process.
+
+Run from the repository root with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import time
+import unittest
+
+import numpy as np
+from sklearn import svm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from training import fit_failed
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'fits are only stopped where os.fork exists')
+class FitTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.X = rs.randn(6000, 10)
+        self.y = (self.X[:, 0] + rs.randn(6000) > 0).astype(int)
+
+    def test_slow_fit_stopped(self):
+        estimator = svm.SVC(C=1000.0, gamma=2.0)
+        start = time.time()
+        self.assertTrue(fit_failed(estimator, self.X, self.y, 0.5))
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(hasattr(estimator, 'support_'))
+
+    def test_fit_returned(self):
+        X, y = self.X[:300], self.y[:300]
+        estimator = svm.SVC(C=1.0, gamma=0.1, probability=True, random_state=0)
+        self.assertFalse(fit_failed(estimator, X, y, 60))
+        expected = svm.SVC(C=1.0, gamma=0.1, probability=True, random_state=0).fit(X, y)
+        np.testing.assert_array_equal(estimator.predict_proba(self.X[:100]), expected.predict_proba(self.X[:100]))
+
+    def test_not_converged(self):
+        self.assertTrue(fit_failed(svm.SVC(C=1000.0, gamma=2.0, max_iter=10), self.X[:300], self.y[:300], 60))
+
+    def test_error_raised(self):
+        self.assertRaises(ValueError, fit_failed, svm.SVC(), self.X[:300], np.zeros(300), 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""Round trips of a fitted SVC through the saved model files and predict.py.
+
+Run from the repository root with: python -m unittest discover -s tests
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from sklearn import preprocessing, svm
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+from predict import loadModel
+from training import saveModel, saveModelBinary
+
+
+class ModelFileTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rs = np.random.RandomState(0)
+        X = rs.randn(300, 6) * 3 + 1
+        y = (X[:, 0] + X[:, 1] + rs.randn(300) > 2).astype(int)
+        cls.normparams = preprocessing.StandardScaler().fit(X)
+        cls.svc = svm.SVC(C=2.0, gamma=0.3, probability=True, random_state=0)
+        cls.svc.fit(cls.normparams.transform(X), y)
+        # Raw, unnormalized windows, as predict.py reads them
+        cls.windows = np.random.RandomState(1).randn(500, 6) * 3 + 1
+        cls.expected = cls.svc.predict_proba(cls.normparams.transform(cls.windows))[:, 1]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def assertSameModel(self, filename, bias):
+        model = loadModel(filename)
+        probs = model.predict_proba(self.windows)
+        np.testing.assert_allclose(probs, self.expected, rtol=0, atol=1e-10)
+        # Scoring one window per block gives the same probabilities
+        np.testing.assert_allclose(model.predict_proba(self.windows, memory_mb=0.001), probs, rtol=0, atol=1e-10)
+
+        self.assertEqual(model.bias, bias)
+        if isinstance(bias, list):
+            expected = np.where(self.expected >= bias[1], 1, np.where(self.expected > bias[0], -1, 0))
+        else:
+            expected = (self.expected >= bias).astype(int)
+        self.assertEqual(model.predict(self.windows).tolist(), expected.tolist())
+        self.assertScoredByPredict(filename, model)
+
+    def assertScoredByPredict(self, filename, model):
+        """Score a feature file with predict.py and compare its output with the loaded model."""
+        features = os.path.join(self.folder, 'features.csv')
+        output = os.path.join(self.folder, 'output.csv')
+        timestamps = 1000 * np.arange(len(self.windows))
+        np.savetxt(features, np.column_stack([timestamps, self.windows]), fmt='%.17g', delimiter=',')
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'predict.py'), '--model', filename,
+                               '--featureFile', features, '--output', output])
+
+        scored = np.loadtxt(output, delimiter=',', ndmin=2)
+        self.assertEqual(scored[:, 0].tolist(), timestamps.tolist())
+        np.testing.assert_allclose(scored[:, 1], self.expected, rtol=0, atol=1e-10)
+        self.assertEqual(scored[:, 2].tolist(), model.predict(self.windows).tolist())
+
+    def test_json(self):
+        filename = os.path.join(self.folder, 'model.json')
+        saveModel(filename, self.svc, self.normparams, 0.42)
+        self.assertSameModel(filename, 0.42)
+
+    def test_json_two_biases(self):
+        filename = os.path.join(self.folder, 'model.json')
+        saveModel(filename, self.svc, self.normparams, [0.3, 0.6], 'puffMarker')
+        self.assertSameModel(filename, [0.3, 0.6])
+
+    def test_binary(self):
+        filename = os.path.join(self.folder, 'model.bin')
+        saveModelBinary(filename, self.svc, self.normparams, 0.42)
+        # A single bias is stored as a pair of equal biases, which labels the same way
+        self.assertSameModel(filename, [0.42, 0.42])
+        # The support vectors are a view of the file's memory map, not a copy
+        base = loadModel(filename).support_vectors
+        while not isinstance(base, np.memmap) and base is not None:
+            base = base.base
+        self.assertIsInstance(base, np.memmap)
+
+    def test_binary_two_biases(self):
+        filename = os.path.join(self.folder, 'model.bin')
+        saveModelBinary(filename, self.svc, self.normparams, [0.3, 0.6], 'puffMarker')
+        self.assertSameModel(filename, [0.3, 0.6])
+
+    def test_binary_same_as_json(self):
+        saveModel(os.path.join(self.folder, 'model.json'), self.svc, self.normparams, [0.3, 0.6])
+        saveModelBinary(os.path.join(self.folder, 'model.bin'), self.svc, self.normparams, [0.3, 0.6])
+        fromJSON = loadModel(os.path.join(self.folder, 'model.json'))
+        fromBinary = loadModel(os.path.join(self.folder, 'model.bin'))
+        np.testing.assert_array_equal(fromBinary.predict_proba(self.windows), fromJSON.predict_proba(self.windows))
+        np.testing.assert_array_equal(fromBinary.predict(self.windows), fromJSON.predict(self.windows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""Equivalence of the puffMarker window labelling indexes with the per-window loops they replaced.
+
+Run from the repository root with: python -m unittest discover -s tests
+"""
+import unittest
+
+import numpy as np
+
+from scripts import load_script
+
+puffMarker = load_script('puffMarker', ['--puffGroundtruth', 'puff_groundtruth.csv'])
+
+
+def reference_found(puff_marks, pid, starttime, endtime, cross_participant):
+    """Puff label of one window as the loop over all puffs computed it; that loop matched any participant."""
+    for puffID, puffTS in puff_marks:
+        if (cross_participant or puffID == pid) and puffTS >= starttime and puffTS <= endtime:
+            return 1
+    return 0
+
+
+def reference_inside(episodes, pid, time, cross_participant):
+    """Whether a window start lies in a smoking episode, as the loop over all episodes computed it."""
+    for episodePID, start, end in episodes:
+        if (cross_participant or episodePID == pid) and time >= start and time <= end:
+            return True
+    return False
+
+
+def reference_filter_episode(participants, starttimes, endtimes, features, puff_marks, episodes,
+                             cross_participant):
+    """analyze_events_with_features_filter_episode as originally written: windows without a puff that start in
+    an episode are dropped.
+    """
+    featureLabels = []
+    finalFeatures = []
+    subjects = []
+    for id, starttime, endtime, f in zip(participants, starttimes, endtimes, features):
+        found = reference_found(puff_marks, id, starttime, endtime, cross_participant)
+        if found == 0 and reference_inside(episodes, id, starttime, cross_participant):
+            continue
+        featureLabels.append(found)
+        finalFeatures.append(f)
+        subjects.append(id)
+    return finalFeatures, featureLabels, subjects
+
+
+def random_episodes(rs, n, participants, step):
+    """Episodes on a coarse time grid, so that they often touch or overlap; some end before they start."""
+    episodes = []
+    for i in range(n):
+        start = step * rs.randint(0, 100)
+        episodes.append((int(rs.choice(participants)), start, start + step * rs.randint(-2, 8)))
+    return episodes
+
+
+def random_windows(rs, n, participants, step):
+    """Windows on a coarse time grid, so that they often start or end exactly on a puff."""
+    pids = rs.choice(participants, n)
+    starttimes = step * rs.randint(0, 100, n)
+    endtimes = starttimes + step * rs.randint(0, 4, n)
+    return pids, starttimes, endtimes
+
+
+class PuffIndexEquivalenceTest(unittest.TestCase):
+
+    def assertSameAsLoop(self, puff_marks, pids, starttimes, endtimes):
+        for cross_participant in (False, True):
+            index = puffMarker.PuffIndex(puff_marks, cross_participant)
+            expected = [reference_found(puff_marks, pid, start, end, cross_participant)
+                        for pid, start, end in zip(pids, starttimes, endtimes)]
+            self.assertEqual(index.found_many(pids, starttimes, endtimes).tolist(), expected)
+            self.assertEqual([index.found(pid, start, end) for pid, start, end in zip(pids, starttimes, endtimes)],
+                             expected)
+
+    def test_random(self):
+        rs = np.random.RandomState(0)
+        for trial in range(100):
+            puff_marks = [(int(rs.randint(1, 4)), 1000 * int(rs.randint(0, 400))) for i in range(rs.randint(0, 40))]
+            # Participant 4 has no puffs
+            self.assertSameAsLoop(puff_marks, *random_windows(rs, rs.randint(0, 80), [1, 2, 3, 4], 4000))
+
+    def test_boundaries(self):
+        puff_marks = [(1, 1000), (1, 5000), (2, 3000)]
+        pids = np.array([1, 1, 1, 1, 2, 2, 2, 3])
+        starttimes = np.array([1000, 1001, 0, 5001, 3000, 0, 3001, 0])
+        endtimes = np.array([1000, 4999, 999, 9000, 3000, 2999, 9000, 9000])
+        self.assertSameAsLoop(puff_marks, pids, starttimes, endtimes)
+
+    def test_without_puffs(self):
+        rs = np.random.RandomState(1)
+        self.assertSameAsLoop([], *random_windows(rs, 20, [1, 2], 1000))
+        self.assertSameAsLoop([(1, 1000)], np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=int))
+
+
+class EpisodeIndexEquivalenceTest(unittest.TestCase):
+
+    def assertSameAsLoop(self, episodes, pids, times):
+        for cross_participant in (False, True):
+            index = puffMarker.EpisodeIndex(episodes, cross_participant)
+            expected = [reference_inside(episodes, pid, time, cross_participant) for pid, time in zip(pids, times)]
+            self.assertEqual(index.inside_many(pids, times).tolist(), expected)
+            self.assertEqual([index.inside(pid, time) for pid, time in zip(pids, times)], expected)
+
+    def test_random(self):
+        rs = np.random.RandomState(2)
+        for trial in range(100):
+            episodes = random_episodes(rs, rs.randint(0, 15), [1, 2, 3], 1000)
+            # Participant 4 has no episodes
+            pids, starttimes, endtimes = random_windows(rs, rs.randint(0, 80), [1, 2, 3, 4], 1000)
+            self.assertSameAsLoop(episodes, pids, starttimes)
+
+    def test_touching_and_overlapping(self):
+        episodes = [(1, 1000, 2000), (1, 2000, 3000), (1, 2500, 2600), (1, 5000, 6000), (1, 5500, 7000),
+                    (2, 1000, 1000), (2, 1001, 1500)]
+        pids = np.array([1] * 10 + [2] * 5)
+        times = np.array([999, 1000, 2000, 2500, 3000, 3001, 4999, 6500, 7000, 7001,
+                          999, 1000, 1001, 1500, 1501])
+        self.assertSameAsLoop(episodes, pids, times)
+
+    def test_inverted(self):
+        # An episode that ends before it starts contains no time
+        episodes = [(1, 3000, 1000), (1, 5000, 4999), (2, 1000, 3000)]
+        pids = np.array([1, 1, 1, 1, 2, 2])
+        times = np.array([1000, 2000, 3000, 5000, 2000, 4000])
+        self.assertSameAsLoop(episodes, pids, times)
+        self.assertSameAsLoop(episodes[:2], pids, times)
+
+    def test_filter_episode(self):
+        rs = np.random.RandomState(3)
+        for trial in range(50):
+            puff_marks = [(int(rs.randint(1, 4)), 1000 * int(rs.randint(0, 400))) for i in range(rs.randint(0, 40))]
+            episodes = random_episodes(rs, rs.randint(0, 15), [1, 2, 3], 4000)
+            pids, starttimes, endtimes = random_windows(rs, rs.randint(1, 80), [1, 2, 3, 4], 4000)
+            features = rs.rand(len(pids), 3)
+            for cross_participant in (False, True):
+                expected = reference_filter_episode(pids, starttimes, endtimes, features, puff_marks, episodes,
+                                                    cross_participant)
+                result = puffMarker.analyze_feature_matrix_filter_episode(pids, starttimes, endtimes, features,
+                                                                          puff_marks, episodes, cross_participant)
+                self.assertEqual(result[0].tolist(), [f.tolist() for f in expected[0]])
+                self.assertEqual(result[1].tolist(), expected[1])
+                self.assertEqual(result[2].tolist(), expected[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""Equivalence of the sort-and-sweep checkStressMarks with checkStressMark applied window by window.
+
+Run from the repository root with: python -m unittest discover -s tests
+"""
+import unittest
+
+import numpy as np
+
+from scripts import load_script
+
+cStress = load_script('cStress', ['--stressFile', 'stress_marks.csv'])
+
+
+def random_marks(rs, n_marks, participants, labels, step):
+    """Stress marks on a coarse time grid, so that marks and windows often share start or end times."""
+    marks = []
+    for i in range(n_marks):
+        start = step * rs.randint(0, 40)
+        marks.append([int(rs.choice(participants)), str(rs.choice(labels)), start, start + step * rs.randint(0, 20)])
+    return marks
+
+
+class StressMarksEquivalenceTest(unittest.TestCase):
+
+    def assertSameAsWindows(self, marks, windows):
+        expected = [cStress.checkStressMark(marks, pid, starttime) for pid, starttime in windows]
+        self.assertEqual(cStress.checkStressMarks(marks, windows), expected)
+
+    def test_random(self):
+        rs = np.random.RandomState(0)
+        for trial in range(100):
+            marks = random_marks(rs, rs.randint(0, 30), [1, 2, 3], ['c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7'], 10000)
+            # Participant 4 has no marks
+            windows = [(int(rs.randint(1, 5)), int(rs.randint(0, 600000))) for i in range(rs.randint(0, 80))]
+            self.assertSameAsWindows(marks, windows)
+
+    def test_boundaries(self):
+        rs = np.random.RandomState(1)
+        for trial in range(100):
+            marks = random_marks(rs, rs.randint(1, 20), [1, 2], ['c1', 'c2', 'c3'], 30000)
+            # Windows start on the grid, so many start exactly at a mark's start or end exactly at its end
+            windows = [(int(rs.randint(1, 3)), 30000 * int(rs.randint(0, 60)) + int(rs.choice([-1, 0, 1])))
+                       for i in range(60)]
+            self.assertSameAsWindows(marks, windows)
+
+    def test_ties(self):
+        rs = np.random.RandomState(2)
+        for trial in range(100):
+            # Long overlapping marks with two labels, so a window is often inside as many of each
+            marks = [[1, str(rs.choice(['c1', 'c2'])), 1000 * rs.randint(0, 10), 1000 * rs.randint(200, 210)]
+                     for i in range(rs.randint(2, 8))]
+            windows = [(1, 1000 * int(rs.randint(0, 150))) for i in range(40)]
+            self.assertSameAsWindows(marks, windows)
+
+    def test_tied_counts(self):
+        marks = [[1, 'c2', 0, 200000], [1, 'c1', 0, 200000], [1, 'c1', 0, 100000], [1, 'c2', 0, 100000]]
+        windows = [(1, 1000), (1, 50000), (1, 150000)]
+        self.assertSameAsWindows(marks, windows)
+        self.assertSameAsWindows(marks[::-1], windows)
+
+    def test_c7_excluded(self):
+        marks = [[1, 'c7', 0, 200000], [1, 'c7', 0, 200000], [1, 'c1', 0, 200000], [2, 'c7', 0, 200000]]
+        windows = [(1, 1000), (2, 1000), (1, 150000)]
+        self.assertSameAsWindows(marks, windows)
+        self.assertEqual(cStress.checkStressMarks(marks, windows), [[('c1', 1)], [], []])
+
+    def test_strict_bounds(self):
+        marks = [[1, 'c1', 10000, 70000 + 10000]]
+        # Starting at the mark's start or ending at its end is not inside it
+        windows = [(1, 10000), (1, 10001), (1, 20000), (1, 20001), (1, 9999)]
+        self.assertSameAsWindows(marks, windows)
+        self.assertEqual(cStress.checkStressMarks(marks, windows), [[], [('c1', 1)], [], [], []])
+
+    def test_without_marks(self):
+        windows = [(1, 1000), (3, 2000)]
+        self.assertSameAsWindows([], windows)
+        self.assertSameAsWindows([[2, 'c1', 0, 100000]], windows)
+        self.assertSameAsWindows([[2, 'c1', 0, 100000]], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
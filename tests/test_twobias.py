@@ -0,0 +1,117 @@
+"""Equivalence of the vectorized Twobias_scorer_CV with the original nested-loop scorer.
+
+Run from the repository root with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from training import Twobias_scorer_CV
+
+
+def reference_twobias(probs, y, ret_bias=False):
+    """Twobias_scorer_CV as originally written, with the O(n^2) loop over (i, j)."""
+    db = np.transpose(np.vstack([probs, y]))
+    db = db[np.argsort(db[:, 0]), :]
+
+    pos = np.sum(y == 1)
+    n = len(y)
+    neg = n - pos
+    tp, tn = pos, 0
+    lost = 0
+
+    optbias = []
+    minloss = 1
+
+    for i in range(n):
+        if db[i, 1] == 1:  # positive
+            tp -= 1.0
+        else:
+            tn += 1.0
+
+        if tp / pos >= 0.95 and tn / neg >= 0.95:
+            optbias = [db[i, 0], db[i, 0]]
+            continue
+
+        running_pos = pos
+        running_neg = neg
+        running_tp = tp
+        running_tn = tn
+
+        for j in range(i + 1, n):
+            if db[j, 1] == 1:  # positive
+                running_tp -= 1.0
+                running_pos -= 1
+            else:
+                running_neg -= 1
+
+            lost = (j - i) * 1.0 / n
+            if running_pos == 0 or running_neg == 0:
+                break
+
+            if running_tp / running_pos >= 0.95 and running_tn / running_neg >= 0.95 and lost < minloss:
+                minloss = lost
+                optbias = [db[i, 0], db[j, 0]]
+
+    if ret_bias:
+        return -minloss, optbias
+    else:
+        return -minloss
+
+
+class TwobiasEquivalenceTest(unittest.TestCase):
+
+    def assertSameAsReference(self, probs, y):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected = reference_twobias(probs, y, True)
+            score, bias = Twobias_scorer_CV(probs, y, True)
+            self.assertEqual(score, expected[0])
+            self.assertEqual(list(bias), list(expected[1]))
+            self.assertEqual(Twobias_scorer_CV(probs, y), expected[0])
+
+    def test_random(self):
+        rs = np.random.RandomState(0)
+        for trial in range(200):
+            n = rs.randint(2, 150)
+            y = (rs.rand(n) < rs.uniform(0.1, 0.9)).astype(int)
+            probs = np.clip(0.5 * y + rs.randn(n) * rs.uniform(0.05, 0.6), 0, 1)
+            self.assertSameAsReference(probs, y)
+
+    def test_ties(self):
+        rs = np.random.RandomState(1)
+        for trial in range(200):
+            n = rs.randint(2, 150)
+            y = (rs.rand(n) < 0.5).astype(int)
+            # Few distinct values, so many windows share a probability
+            probs = np.round(np.clip(0.3 * y + rs.rand(n) * 0.7, 0, 1), rs.randint(0, 3))
+            self.assertSameAsReference(probs, y)
+
+    def test_skewed_classes(self):
+        rs = np.random.RandomState(2)
+        for trial in range(200):
+            n = rs.randint(20, 300)
+            y = (rs.rand(n) < rs.choice([0.01, 0.03, 0.97, 0.99])).astype(int)
+            probs = np.clip(0.6 * y + rs.rand(n) * 0.5, 0, 1)
+            self.assertSameAsReference(probs, y)
+
+    def test_separable(self):
+        rs = np.random.RandomState(3)
+        for trial in range(50):
+            n = rs.randint(2, 100)
+            y = (rs.rand(n) < 0.5).astype(int)
+            self.assertSameAsReference(0.5 * y + 0.4 * rs.rand(n), y)
+
+    def test_single_class(self):
+        rs = np.random.RandomState(4)
+        for label in (0, 1):
+            for n in (1, 2, 10, 57):
+                self.assertSameAsReference(rs.rand(n), np.zeros(n, dtype=int) + label)
+
+
+if __name__ == '__main__':
+    unittest.main()
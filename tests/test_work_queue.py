@@ -0,0 +1,98 @@
+"""WorkQueue.map against worker processes serving a temporary queue folder.
+
+Run from the repository root with: python -m unittest discover -s tests
+"""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(TESTS, os.pardir)
+sys.path.insert(0, ROOT)
+from queue_tasks import slow_echo, weighted_sum
+from training import WorkQueue
+
+SERVE = ('import sys; sys.path[:0] = [%r, %r]; from training import WorkQueue; '
+         'WorkQueue(sys.argv[1], heartbeat=0.1, poll=0.05).serve()' % (ROOT, TESTS))
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.queue = os.path.join(self.folder, 'queue')
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            if worker.poll() is None:
+                worker.kill()
+                worker.wait()
+        shutil.rmtree(self.folder)
+
+    def start_workers(self, n):
+        self.workers.extend(subprocess.Popen([sys.executable, '-c', SERVE, self.queue]) for i in range(n))
+
+    def test_map(self):
+        self.start_workers(3)
+        queue = WorkQueue(self.queue, task_timeout=30, poll=0.05)
+        X, other, y = np.arange(12.0).reshape(4, 3), np.ones((2, 2)), np.array([0, 1, 1, 0])
+        tasks = [(X if i % 3 else other, i, (0.5 * i,)) for i in range(20)]
+        self.assertEqual(queue.map(weighted_sum, y, tasks),
+                         [weighted_sum(estimator, X, y, *arguments) for X, estimator, arguments in tasks])
+
+        # A second map on the same queue, as every round of a search does
+        self.assertEqual(queue.map(weighted_sum, y, tasks[:5]),
+                         [weighted_sum(estimator, X, y, *arguments) for X, estimator, arguments in tasks[:5]])
+
+        queue.stop()
+        self.assertEqual([worker.wait() for worker in self.workers], [0, 0, 0])
+
+    def test_lost_worker(self):
+        self.start_workers(2)
+        log = os.path.join(self.folder, 'log')
+        queue = WorkQueue(self.queue, task_timeout=1.5, poll=0.05)
+
+        # Kill the worker that claims task 0 once it has started it
+        def kill_claimant():
+            while True:
+                for claim in os.listdir(os.path.join(self.queue, 'claimed')):
+                    if claim.split('.', 1)[0].endswith('-000000'):
+                        pid = int(claim.split('.', 1)[1].rsplit('.', 1)[0].rsplit('-', 1)[1])
+                        os.kill(pid, signal.SIGKILL)
+                        return
+                time.sleep(0.02)
+
+        killer = threading.Thread(target=kill_claimant)
+        killer.start()
+        y = np.zeros(3)
+        self.assertEqual(queue.map(slow_echo, y, [(y, i, (0.5, log)) for i in range(4)]), [0, 1, 2, 3])
+        killer.join()
+
+        with open(log) as f:
+            starts = f.read().split()
+        # Task 0 was started by the killed worker and again by the other one
+        self.assertEqual(starts.count('0'), 2)
+        self.assertEqual(sorted(set(starts)), ['0', '1', '2', '3'])
+
+        queue.stop()
+        self.assertEqual(sorted(worker.wait() for worker in self.workers), [-signal.SIGKILL, 0])
+
+    def test_no_workers(self):
+        queue = WorkQueue(self.queue, task_timeout=1, poll=0.05)
+        start = time.time()
+        with self.assertRaises(RuntimeError):
+            queue.map(weighted_sum, np.zeros(3), [(np.zeros(3), 1, (0,))])
+        self.assertLess(time.time() - start, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1916 @@
+# Copyright (c) 2015, University of Memphis, MD2K Center of Excellence
+#  - Timothy Hnat <twhnat@memphis.edu>
+#  - Karen Hovsepian <karoaper@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Model search, scoring and model output shared by cStress.py and puffMarker.py."""
+import hashlib
+import heapq
+import json
+import os
+import pickle
+import select
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import numpy as np
+from collections import OrderedDict
+from collections import Sized
+from pathlib import Path
+from scipy.linalg import cho_factor, cho_solve
+from scipy.stats import norm
+from sklearn import svm, metrics, preprocessing
+from sklearn.base import BaseEstimator, ClassifierMixin, clone, is_classifier
+from sklearn.cluster import KMeans
+from sklearn.cross_validation import check_cv
+from sklearn.externals.joblib import Parallel, cpu_count, delayed
+from sklearn.grid_search import GridSearchCV, RandomizedSearchCV, ParameterSampler, ParameterGrid
+from sklearn.kernel_approximation import Nystroem
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics.pairwise import rbf_kernel
+from sklearn.utils import check_random_state
+from sklearn.utils.validation import _num_samples, indexable
+
+from predict import MODEL_HEADER, MODEL_MAGIC, MODEL_VERSION, coupled_probability
+
+
+def cv_fit_and_score(estimator, X, y, scorer, parameters, cv, store=None, fit_timeout=None, return_probs=False):
+    """Fit estimator and compute scores for a given dataset split.
+    Parameters
+    ----------
+    estimator : estimator object implementing 'fit'
+        The object to use to fit the data.
+    X : array-like of shape at least 2D
+        The data to fit.
+    y : array-like, optional, default: None
+        The target variable to try to predict in the case of
+        supervised learning.
+    scorer : callable
+        A scorer callable object / function with signature
+        ``scorer(estimator, X, y)``.
+    parameters : dict or None
+        Parameters to be set on the estimator.
+    cv:	Cross-validation fold indeces
+    store : ResultStore or None
+        If given, the out-of-fold probabilities and score are recorded in it.
+    fit_timeout : float or None
+        Seconds after which a fold fit is stopped; a candidate with a stopped or non-converged fit scores
+        FAILED_SCORE.
+    return_probs : boolean
+        If True, the out-of-fold probabilities are returned as well.
+    Returns
+    -------
+    score : float
+        CV score on whole set.
+    parameters : dict or None, optional
+        The parameters that have been evaluated.
+    probs : array, only with return_probs
+        The out-of-fold probabilities.
+    """
+    estimator.set_params(**parameters)
+    cv_probs_ = cross_val_probs(estimator, X, y, cv, fit_timeout=fit_timeout)
+    score = score_candidates(scorer, cv_probs_[np.newaxis], y)[0]
+
+    if store is not None:
+        store.put(parameters, scorer, score, cv_probs_)
+
+    if return_probs:
+        return [score, parameters, cv_probs_]
+    return [score, parameters]  # scoring_time]
+
+
+def effective_n_jobs(n_jobs):
+    """Number of processes Parallel runs for n_jobs, where -1 means all CPUs, -2 all but one and so on."""
+    return max(1, cpu_count() + 1 + n_jobs if n_jobs < 0 else n_jobs)
+
+
+def canonical_params(parameters):
+    """Stable string form of a parameter dict, usable as a grouping or hashing key."""
+    return json.dumps(parameters, sort_keys=True)
+
+
+def physical_memory_mb():
+    """Physical memory of this machine in megabytes, or 2048 where the system does not report it."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2.0 ** 20
+    except (AttributeError, ValueError, OSError):
+        return 2048
+
+
+def kernel_gamma(estimator, parameters, n_features):
+    """The gamma of a candidate's RBF kernel, or None for a candidate with another kernel."""
+    if parameters.get('kernel', getattr(estimator, 'kernel', 'rbf')) != 'rbf':
+        return None
+    gamma = parameters.get('gamma', estimator.gamma)
+    return 1.0 / n_features if gamma == 'auto' else gamma
+
+
+def cv_fit_and_score_kernel(estimator, K, y, scorer, parameter_list, cv, store=None, fit_timeout=None,
+                            return_probs=False):
+    """Fit and score a group of candidates that share one RBF gamma on K, the kernel matrix of all windows.
+
+    K is computed once by the search (SharedArrays.kernel). The train/test submatrices of each fold are sliced
+    once and every candidate is fitted on them with kernel='precomputed'. Each C is fitted from scratch: libsvm
+    cannot start from another C's solution, and refitting on the previous C's support vectors until no other
+    window violates the margin was measured 1.5 to 2.3 times slower, as libsvm's shrinking already leaves those
+    windows out.
+    Returns a list of [score, parameters], or [score, parameters, probs] with return_probs, one entry per
+    candidate.
+    """
+    cv_probs_ = np.zeros((len(parameter_list), len(y)))
+    for train, test in cv:
+        K_train = K[np.ix_(train, train)]
+        K_test = K[np.ix_(test, train)]
+        for i, parameters in enumerate(parameter_list):
+            if np.isnan(cv_probs_[i, 0]):
+                # A failed fold fails the candidate, so its remaining folds are not fitted
+                continue
+            estimator.set_params(**parameters).set_params(kernel='precomputed')
+            if fit_failed(estimator, K_train, y[train], fit_timeout):
+                cv_probs_[i] = np.nan
+            else:
+                cv_probs_[i, test] = predict_scores(estimator, K_test)
+        del K_train, K_test
+
+    out = []
+    for score, parameters, probs in zip(score_candidates(scorer, cv_probs_, y), parameter_list, cv_probs_):
+        if store is not None:
+            store.put(parameters, scorer, score, probs)
+        out.append([score, parameters, probs] if return_probs else [score, parameters])
+
+    return out
+
+
+def fold_fit_and_predict(estimator, X, y, parameter_list, train, test, precomputed=False, fit_timeout=None):
+    """Fit every candidate of parameter_list on one training fold and predict its test fold.
+
+    This is the unit of work of the fold-parallel search. With precomputed, X is the kernel matrix of all
+    windows for the gamma the candidates share, and they are fitted on its fold slices as in
+    cv_fit_and_score_kernel.
+    Returns a list with one array of test fold probabilities per candidate, NaN for a candidate whose fit
+    failed to converge or was stopped after fit_timeout seconds.
+    """
+    if precomputed:
+        K_train = X[np.ix_(train, train)]
+        K_test = X[np.ix_(test, train)]
+
+    fold_probs = []
+    for parameters in parameter_list:
+        estimator.set_params(**parameters)
+        if not precomputed:
+            fold_probs.append(fit_predict_fold(estimator, X, y, train, test, fit_timeout))
+        else:
+            estimator.set_params(kernel='precomputed')
+            if fit_failed(estimator, K_train, y[train], fit_timeout):
+                fold_probs.append(np.zeros(len(test)) + np.nan)
+            else:
+                fold_probs.append(predict_scores(estimator, K_test))
+
+    return fold_probs
+
+
+def group_by_kernel(parameter_iterable):
+    """Group RBF candidates into lists that share gamma, so each group needs one kernel."""
+    groups = OrderedDict()
+    for parameters in parameter_iterable:
+        if parameters.get('kernel', 'rbf') != 'rbf':
+            groups[canonical_params(parameters)] = [parameters]
+            continue
+        key = canonical_params(dict((k, v) for k, v in parameters.items() if k not in ['C', 'class_weight']))
+        groups.setdefault(key, []).append(parameters)
+
+    return sorted(groups.values(), key=lambda group: group[0].get('gamma'))
+
+
+def split_evenly(items, parts):
+    """Split items into min(parts, len(items)) consecutive lists whose lengths differ by at most one."""
+    parts = max(1, min(parts, len(items)))
+    return [items[i * len(items) // parts:(i + 1) * len(items) // parts] for i in range(parts)]
+
+
+def prune_param_grid(param_grid):
+    """Drop the class_weight settings of param_grid that give a class zero or negative weight.
+
+    A class weighted 0 has its alphas held at 0, so the SVC ignores that class and fits little more than an
+    intercept, for every C and gamma. Returns the pruned grid and the dropped settings.
+    """
+    pruned = dict(param_grid)
+    dropped = []
+    if 'class_weight' in param_grid:
+        kept = []
+        for class_weight in param_grid['class_weight']:
+            if isinstance(class_weight, dict) and min(class_weight.values()) <= 0:
+                dropped.append(class_weight)
+            else:
+                kept.append(class_weight)
+        pruned['class_weight'] = kept
+    return pruned, dropped
+
+
+class ResultStore(object):
+    """SQLite file holding the out-of-fold probabilities and score of every evaluated candidate.
+
+    Rows are keyed by a hash of the data, the fold layout, the estimator class and its full parameter dict with
+    the candidate's values filled in, so an interrupted or widened search with the same estimator settings only
+    evaluates candidates it has not seen yet. Workers write their own rows as soon as a candidate is scored; the
+    connection is reopened in each process.
+    """
+
+    def __init__(self, filename, X, y, cv, estimator, probability=True):
+        self.filename = filename
+        self.estimator_params = estimator.get_params(deep=False)
+
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(X, dtype=np.float64).view(np.uint8))
+        digest.update(np.ascontiguousarray(y, dtype=np.float64).view(np.uint8))
+        for train, test in cv:
+            digest.update(np.ascontiguousarray(test, dtype=np.int64).view(np.uint8))
+            digest.update(b'|')
+        if not probability:
+            # Decision function values are stored in place of probabilities
+            digest.update(b'decision_function')
+        digest.update(type(estimator).__name__.encode('utf-8'))
+        self.dataset = digest.hexdigest()
+
+        self._connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filename, timeout=600)
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, dataset TEXT, '
+                                         'parameters TEXT, scorer TEXT, score REAL, probs BLOB)')
+        return self._connection
+
+    def key(self, parameters):
+        # The parameters the search leaves fixed, such as probability or n_components, are part of the key too
+        estimator_params = dict(self.estimator_params)
+        estimator_params.update(parameters)
+        return hashlib.sha1((self.dataset + json.dumps(estimator_params, sort_keys=True, default=repr))
+                            .encode('utf-8')).hexdigest()
+
+    def put(self, parameters, scorer, score, probs):
+        connection = self._connect()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                               (self.key(parameters), self.dataset, canonical_params(parameters), scorer.__name__,
+                                float(score), sqlite3.Binary(np.asarray(probs, dtype=np.float64).tostring())))
+
+    def get(self, parameters):
+        """Return (scorer name, score, out-of-fold probabilities) of a stored candidate, or None."""
+        row = self._connect().execute('SELECT scorer, score, probs FROM results WHERE key = ?',
+                                      (self.key(parameters),)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], np.frombuffer(bytes(row[2]), dtype=np.float64)
+
+    def split(self, parameter_iterable, scorer, y):
+        """Separate candidates into those still to evaluate and [score, parameters] of the stored ones.
+
+        Stored candidates that were scored with a different scorer, or with a MultiScorer, whose secondary
+        scores are not stored, are rescored from their probabilities. Candidates whose fits failed are evaluated
+        again, as the fit budget may have changed.
+        """
+        pending = []
+        done = []
+        for parameters in parameter_iterable:
+            stored = self.get(parameters)
+            if stored is None or np.any(np.isnan(stored[2])):
+                pending.append(parameters)
+            elif stored[0] == scorer.__name__ and not isinstance(scorer, MultiScorer):
+                done.append([stored[1], parameters])
+            else:
+                done.append([scorer(stored[2], y), parameters])
+
+        return pending, done
+
+
+class SharedArrays(object):
+    """Writes arrays once to .npy files in a temporary folder and hands back read-only memory maps of them.
+
+    Parallel pickles a memory-mapped array as its file name, so every worker maps the same pages instead of
+    receiving its own copy of the data with each task.
+    """
+
+    def __init__(self, folder=None):
+        self.folder = tempfile.mkdtemp(prefix='search_', dir=folder)
+        self._count = 0
+
+    def _filename(self):
+        self._count += 1
+        return os.path.join(self.folder, '%d.npy' % (self._count - 1))
+
+    def share(self, array):
+        filename = self._filename()
+        np.save(filename, np.asarray(array))
+        return np.load(filename, mmap_mode='r')
+
+    def kernel(self, X, gamma, block_mb=64):
+        """RBF kernel matrix of the windows of X, computed in blocks of rows of about block_mb megabytes straight
+        into its file, so that this process never holds more of it than one block.
+        """
+        filename = self._filename()
+        n_samples = X.shape[0]
+        K = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64, shape=(n_samples, n_samples))
+        rows = max(1, block_mb * 2 ** 20 // (8 * n_samples))
+        for start in range(0, n_samples, rows):
+            K[start:start + rows] = rbf_kernel(X[start:start + rows], X, gamma=gamma)
+        K.flush()
+        del K
+        return np.load(filename, mmap_mode='r')
+
+    def release(self, array):
+        """Remove the file of an array from share() or kernel(), once no task needs it any more."""
+        os.remove(array.filename)
+
+    def close(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def worker_name():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """Task queue in a directory shared by a search and worker processes, on this or any other machine.
+
+    map() writes the data arrays once to data/ and one pickled task per unit of work to tasks/. A worker claims
+    a task by renaming it into claimed/, which succeeds for exactly one of them, and writes the result to done/,
+    again through a rename, so no one reads a partial file. While it runs a task, the worker touches its claim
+    every heartbeat seconds (task_timeout / 4 by default). A claim whose modification time has not changed for
+    task_timeout seconds is put back into tasks/, which retries the tasks of a lost worker; a task that runs
+    twice gives the same result either way. If for task_timeout seconds no task is claimed, touched or
+    finished, for instance because no worker is running, map() raises a RuntimeError. Results are returned in
+    task order, so they merge exactly as Parallel's would, whichever worker ran which task.
+    """
+
+    def __init__(self, folder, task_timeout=600, poll=0.5, heartbeat=None):
+        self.folder = folder
+        self.task_timeout = task_timeout
+        self.poll = poll
+        self.heartbeat = task_timeout / 4.0 if heartbeat is None else heartbeat
+        self.stop_file = os.path.join(folder, 'stop')
+        for name in ['data', 'tasks', 'claimed', 'done']:
+            try:
+                os.makedirs(os.path.join(folder, name))
+            except OSError:
+                if not os.path.isdir(os.path.join(folder, name)):
+                    raise
+        self._arrays = OrderedDict()
+
+    def _write(self, filename, write):
+        # Written under a hidden name, which workers skip, and renamed into place
+        temp = os.path.join(os.path.dirname(filename), '.%s.%s' % (worker_name(), os.path.basename(filename)))
+        write(temp)
+        os.rename(temp, filename)
+
+    def _dump(self, filename, value):
+        def write(temp):
+            with open(temp, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        self._write(filename, write)
+
+    def share(self, array):
+        """Name of a file under data/ holding array, written once per distinct content. An array that already
+        is a memory map of a whole file in the queue folder, such as a kernel from shared_arrays(), is passed by
+        the name of that file.
+        """
+        filename = getattr(array, 'filename', None)
+        if (filename is not None and filename.startswith(os.path.abspath(self.folder) + os.sep) and
+                array.offset + array.nbytes == os.path.getsize(filename)):
+            return filename
+        array = np.ascontiguousarray(array)
+        digest = hashlib.sha1((str(array.dtype) + str(array.shape)).encode('utf-8'))
+        digest.update(array.view(np.uint8))
+        filename = os.path.join(self.folder, 'data', digest.hexdigest() + '.npy')
+        if not os.path.exists(filename):
+            self._write(filename, lambda temp: np.save(temp, array))
+        return filename
+
+    def _list(self, name):
+        # stop() removes the folders, which the next search creates again
+        try:
+            return sorted(os.listdir(os.path.join(self.folder, name)))
+        except OSError:
+            return []
+
+    def load(self, filename):
+        # Only the last few arrays stay mapped, so that the files of kernels the search has removed are freed
+        if filename in self._arrays:
+            self._arrays[filename] = self._arrays.pop(filename)
+        else:
+            self._arrays[filename] = np.load(filename, mmap_mode='r')
+            while len(self._arrays) > 4:
+                self._arrays.popitem(last=False)
+        return self._arrays[filename]
+
+    def shared_arrays(self):
+        """SharedArrays in data/, for arrays that the workers read by their file names."""
+        return SharedArrays(os.path.join(self.folder, 'data'))
+
+    def map(self, function, y, tasks):
+        """[function(estimator, X, y, *arguments) for X, estimator, arguments in tasks], run by the workers."""
+        if os.path.exists(self.stop_file):
+            os.remove(self.stop_file)
+
+        y_file = self.share(y)
+        # Tasks mostly share a few arrays, each of which is written or hashed once
+        X_files = {}
+        job = '%d-%d' % (int(time.time() * 1000), os.getpid())
+        names = ['%s-%06d' % (job, i) for i in range(len(tasks))]
+        for name, (X, estimator, arguments) in zip(names, tasks):
+            if id(X) not in X_files:
+                X_files[id(X)] = self.share(X)
+            self._dump(os.path.join(self.folder, 'tasks', name + '.pkl'),
+                       (function, X_files[id(X)], y_file, estimator, arguments))
+
+        results = {}
+        # Last seen modification time of each claim and when it was seen to change, by this machine's clock, so
+        # that the clocks of the workers and the file server do not matter
+        heartbeats = {}
+        progress_at = time.time()
+        while len(results) < len(names):
+            for name in names:
+                done = os.path.join(self.folder, 'done', name + '.pkl')
+                if name not in results and os.path.exists(done):
+                    with open(done, 'rb') as f:
+                        results[name] = pickle.load(f)
+                    os.remove(done)
+                    progress_at = time.time()
+                    if results[name][0] == 'error':
+                        raise RuntimeError('Task %s failed in a worker:\n%s' % (name, results[name][1]))
+
+            now = time.time()
+            claims = set()
+            for claim in self._list('claimed'):
+                name = claim.split('.', 1)[0]
+                if not name.startswith(job + '-') or name in results:
+                    continue
+                filename = os.path.join(self.folder, 'claimed', claim)
+                try:
+                    mtime = os.path.getmtime(filename)
+                except OSError:
+                    continue
+                claims.add(claim)
+                if claim not in heartbeats or heartbeats[claim][0] != mtime:
+                    heartbeats[claim] = (mtime, now)
+                    progress_at = now
+                elif now - heartbeats[claim][1] > self.task_timeout:
+                    try:
+                        os.rename(filename, os.path.join(self.folder, 'tasks', name + '.pkl'))
+                    except OSError:
+                        pass
+            for claim in set(heartbeats) - claims:
+                del heartbeats[claim]
+
+            if len(results) < len(names):
+                if now - progress_at > self.task_timeout:
+                    raise RuntimeError('No task of %s was claimed, touched or finished for %g seconds; are workers '
+                                       'serving it?' % (self.folder, self.task_timeout))
+                time.sleep(self.poll)
+
+        return [results[name][1] for name in names]
+
+    def serve(self):
+        """Run tasks until a search writes the stop file. A stop file left by an earlier search is ignored."""
+        stale = os.path.exists(self.stop_file)
+        while True:
+            if not os.path.exists(self.stop_file):
+                stale = False
+            elif not stale:
+                return
+
+            for task in self._list('tasks'):
+                if task.startswith('.'):
+                    continue
+                name = task[:-len('.pkl')]
+                claim = os.path.join(self.folder, 'claimed', '%s.%s.pkl' % (name, worker_name()))
+                try:
+                    os.rename(os.path.join(self.folder, 'tasks', task), claim)
+                    with open(claim, 'rb') as f:
+                        function, X_file, y_file, estimator, arguments = pickle.load(f)
+                except (IOError, OSError):
+                    # Claimed by another worker, or put back by the search meanwhile
+                    continue
+
+                beating = threading.Event()
+                heartbeat = threading.Thread(target=self._beat, args=(claim, beating))
+                heartbeat.daemon = True
+                heartbeat.start()
+                try:
+                    result = ('result', function(estimator, self.load(X_file), self.load(y_file), *arguments))
+                except Exception:
+                    result = ('error', traceback.format_exc())
+                finally:
+                    beating.set()
+                    heartbeat.join()
+                self._dump(os.path.join(self.folder, 'done', name + '.pkl'), result)
+                try:
+                    os.remove(claim)
+                except OSError:
+                    pass
+                break
+            else:
+                time.sleep(self.poll)
+
+    def _beat(self, claim, stopped):
+        """Touch claim every heartbeat seconds until stopped is set."""
+        while not stopped.wait(self.heartbeat):
+            try:
+                os.utime(claim, None)
+            except OSError:
+                # Put back by the search after all; the result is still written and used
+                pass
+
+    def stop(self):
+        """Tell the workers to exit, and remove the data and any leftover tasks and results."""
+        for name in ['data', 'tasks', 'claimed', 'done']:
+            shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+        with open(self.stop_file, 'w'):
+            pass
+
+
+class ModifiedSearchMixin(object):
+    """Search loop shared by ModifiedGridSearchCV and ModifiedRandomizedSearchCV.
+
+    With keep_probs=k, top_probs_ holds [score, parameters, out-of-fold probabilities] of the k best candidates,
+    so the final evaluation needs no further fits. Each candidate's probabilities come back with its score and
+    only the k best are held, in a heap; candidates skipped because they are in result_store have theirs read
+    back from it when they make the top k.
+
+    scoring may be a MultiScorer. Its first scorer drives the search and best_params_; leaderboards_ and
+    best_params_by_scorer_ then hold, per scorer name, the evaluated candidates as [score, parameters] sorted
+    best first and the best of them. Halving and refinement pick their next rounds by the first scorer only,
+    so the other leaderboards cover the candidates that search reached.
+
+    A candidate with a fold fit that does not converge within the estimator's max_iter, or that is stopped after
+    fit_timeout seconds (fit_failed), scores FAILED_SCORE and is ranked last. In the per-candidate modes its remaining
+    folds are skipped.
+
+    With precompute_kernel, each gamma's kernel matrix is computed once by the search and memory-mapped by the
+    workers; kernel_cache_mb (half the physical memory by default) bounds the kernels and the workers' fold
+    slices of them together.
+
+    With work_queue, a directory shared with worker processes (WorkQueue.serve), the (candidates, fold) tasks of
+    the fold-parallel mode are run by those workers instead of local processes.
+    """
+
+    def _fit(self, X, y, parameter_iterable):
+        """Actual fitting,  performing the search over parameters."""
+
+        estimator = self.estimator
+        cv = self.cv
+
+        n_samples = _num_samples(X)
+        X, y = indexable(X, y)
+
+        if y is not None:
+            if len(y) != n_samples:
+                raise ValueError('Target variable (y) has a different number '
+                                 'of samples (%i) than data (X: %i samples)'
+                                 % (len(y), n_samples))
+        cv = check_cv(cv, X, y, classifier=is_classifier(estimator))
+
+        if self.verbose > 0:
+            if isinstance(parameter_iterable, Sized):
+                n_candidates = len(parameter_iterable)
+                print("Fitting {0} folds for each of {1} candidates, totalling"
+                      " {2} fits".format(len(cv), n_candidates,
+                                         n_candidates * len(cv)))
+
+        base_estimator = clone(self.estimator)
+
+        shared = None
+        X_search, y_search, cv_search = X, y, cv
+        if self.memmap_folder is not None:
+            # Workers read X, y and the fold indices from one memory-mapped copy
+            shared = SharedArrays(self.memmap_folder)
+            X_search, y_search = shared.share(X), shared.share(y)
+            cv_search = [(shared.share(train), shared.share(test)) for train, test in cv]
+
+        self._top_probs = []
+        try:
+            out = self._search(base_estimator, X_search, y_search, cv_search, parameter_iterable)
+        finally:
+            if shared is not None:
+                shared.close()
+        if self.keep_probs:
+            self.top_probs_ = [list(entry) for entry in sorted(self._top_probs, reverse=True)]
+        del self._top_probs
+
+        n_failed = sum(1 for score, parameters in out if score == FAILED_SCORE)
+        if n_failed == len(out):
+            raise ValueError('Every candidate failed to fit within the iteration or time budget')
+        if n_failed and self.verbose > 0:
+            print("{0} candidates failed to fit within the iteration or time budget".format(n_failed))
+
+        best = sorted(out, reverse=True)[0]
+        self.best_params_ = best[1]
+        self.best_score_ = best[0]
+
+        if isinstance(self.scoring, MultiScorer):
+            self.leaderboards_ = {}
+            self.best_params_by_scorer_ = {}
+            for name in self.scoring.names:
+                self.leaderboards_[name] = sorted([[score.scores[name], parameters] for score, parameters in out],
+                                                  reverse=True)
+                self.best_params_by_scorer_[name] = self.leaderboards_[name][0][1]
+
+        if self.refit:
+            # fit the best estimator using the entire dataset
+            # clone first to work around broken estimators
+            best_estimator = clone(base_estimator).set_params(
+                **best[1])
+            if y is not None:
+                best_estimator.fit(X, y, **self.fit_params)
+            else:
+                best_estimator.fit(X, **self.fit_params)
+            self.best_estimator_ = best_estimator
+
+        return self
+
+    def _keep(self, score, parameters, probs):
+        """Offer a candidate to the heap of the keep_probs best. probs may also be a function returning them,
+        which is only called when the candidate is kept.
+        """
+        if len(self._top_probs) == self.keep_probs and (score, parameters) <= self._top_probs[0][:2]:
+            return
+        if callable(probs):
+            probs = probs()
+        # A copy, so that a kept row does not hold on to the whole matrix of its chunk
+        entry = (score, parameters, np.array(probs))
+        if len(self._top_probs) < self.keep_probs:
+            heapq.heappush(self._top_probs, entry)
+        else:
+            heapq.heapreplace(self._top_probs, entry)
+
+    def _stores_probabilities(self, base_estimator):
+        """Whether out-of-fold vectors hold probabilities rather than decision function values."""
+        return getattr(base_estimator, 'probability', True)
+
+    def _search(self, base_estimator, X, y, cv, parameter_iterable):
+        """Evaluate every candidate and return a list of [score, parameters]."""
+        return self._evaluate(base_estimator, X, y, cv, parameter_iterable, self.scoring)
+
+    def _evaluate(self, base_estimator, X, y, cv, parameter_iterable, scorer):
+        """Cross-validate every candidate over the folds in cv and return a list of [score, parameters]."""
+        # The subset rounds of halving score other folds than the ones top_probs_ is about
+        keep = self.keep_probs > 0 and scorer is self.scoring
+
+        store = None
+        done = []
+        if self.result_store is not None:
+            store = ResultStore(self.result_store, X, y, cv, base_estimator,
+                                self._stores_probabilities(base_estimator))
+            parameter_iterable, done = store.split(parameter_iterable, scorer, y)
+            if self.verbose > 0:
+                print("Skipping {0} candidates already in {1}".format(len(done), self.result_store))
+            if keep:
+                for score, parameters in done:
+                    self._keep(score, parameters, lambda: store.get(parameters)[2])
+
+        if self.precompute_kernel:
+            return done + self._evaluate_kernels(base_estimator, X, y, cv, parameter_iterable, scorer, store, keep)
+        return done + self._evaluate_plain(base_estimator, X, y, cv, parameter_iterable, scorer, store, keep)
+
+    def _evaluate_plain(self, base_estimator, X, y, cv, parameter_iterable, scorer, store, keep):
+        """Evaluate candidates with libsvm computing the kernel itself, per candidate or per (candidate, fold)."""
+        if self.fold_parallel or self.work_queue is not None:
+            units = [(X, [parameters], False) for parameters in parameter_iterable]
+            return self._evaluate_folds(base_estimator, y, cv, units, scorer, store, keep)
+
+        out = Parallel(
+            n_jobs=self.n_jobs, verbose=self.verbose,
+            pre_dispatch=self.pre_dispatch
+        )(
+            delayed(cv_fit_and_score)(clone(base_estimator), X, y, scorer,
+                                      parameters, cv=cv, store=store, fit_timeout=self.fit_timeout,
+                                      return_probs=keep)
+            for parameters in parameter_iterable)
+        return self._kept(out, keep)
+
+    def _kept(self, out, keep):
+        """Offer each [score, parameters, probs] of out to top_probs_ and return them as [score, parameters]."""
+        if not keep:
+            return out
+        for score, parameters, probs in out:
+            self._keep(score, parameters, probs)
+        return [[score, parameters] for score, parameters, probs in out]
+
+    def _evaluate_kernels(self, base_estimator, X, y, cv, parameter_iterable, scorer, store, keep):
+        """Evaluate RBF candidates on kernel matrices computed once per gamma in this process and shared with the
+        workers as memory maps (SharedArrays.kernel).
+
+        The kernels in use and one fold's train and test slices per running worker, up to a kernel's worth
+        each, must fit kernel_cache_mb. That decides how many local workers run on a kernel and how many gammas'
+        kernels are computed at a time. When not even one kernel and one worker fit, the candidates are fitted
+        on libsvm's own kernel instead. Each gamma's candidates are split into at least as many tasks as there
+        are workers.
+        """
+        rbf, other = [], []
+        for parameters in parameter_iterable:
+            (other if kernel_gamma(base_estimator, parameters, X.shape[1]) is None else rbf).append(parameters)
+        out = self._evaluate_plain(base_estimator, X, y, cv, other, scorer, store, keep) if other else []
+        if not rbf:
+            return out
+
+        n_jobs = effective_n_jobs(self.n_jobs)
+        n_mb = 8.0 * len(y) ** 2 / 2 ** 20
+        budget_mb = physical_memory_mb() / 2 if self.kernel_cache_mb is None else self.kernel_cache_mb
+        slots = int(budget_mb // n_mb)
+        if slots < 2:
+            if self.verbose > 0:
+                print("A kernel of {0} windows takes {1:.0f} MB, twice of which does not fit kernel_cache_mb={2:.0f};"
+                      " fitting without precomputed kernels".format(len(y), n_mb, budget_mb))
+            return out + self._evaluate_plain(base_estimator, X, y, cv, rbf, scorer, store, keep)
+
+        n_workers = min(n_jobs, slots - 1)
+        per_round = max(1, slots - n_workers)
+        if n_workers < n_jobs and self.work_queue is None and self.verbose > 0:
+            print("Kernels of {0} windows take {1:.0f} MB each; kernel_cache_mb={2:.0f} fits {3} of {4} workers on "
+                  "them".format(len(y), n_mb, budget_mb, n_workers, n_jobs))
+
+        folds = list(cv)
+        fold_tasks = self.fold_parallel or self.work_queue is not None
+        if self.work_queue is not None:
+            # Workers on other machines read the kernels from the queue folder
+            shared = WorkQueue(self.work_queue, self.task_timeout).shared_arrays()
+        else:
+            shared = SharedArrays(self.memmap_folder)
+        groups = group_by_kernel(rbf)
+        try:
+            for start in range(0, len(groups), per_round):
+                round_groups = groups[start:start + per_round]
+                kernels = [shared.kernel(X, kernel_gamma(base_estimator, group[0], X.shape[1]))
+                           for group in round_groups]
+                units = []
+                for K, group in zip(kernels, round_groups):
+                    if fold_tasks:
+                        # Each chunk of fold_chunk_size candidates is split again so that its (part, fold) tasks
+                        # keep every worker busy
+                        n_parts = -(-n_workers // len(folds))
+                        pieces = [group[i:i + self.fold_chunk_size]
+                                  for i in range(0, len(group), self.fold_chunk_size)]
+                    else:
+                        n_parts = -(-n_workers // len(round_groups))
+                        pieces = [group]
+                    units.extend((K, part, True) for piece in pieces for part in split_evenly(piece, n_parts))
+
+                if fold_tasks:
+                    out.extend(self._evaluate_folds(base_estimator, y, folds, units, scorer, store, keep, n_workers))
+                else:
+                    parts = Parallel(
+                        n_jobs=n_workers, verbose=self.verbose,
+                        pre_dispatch=self.pre_dispatch
+                    )(
+                        delayed(cv_fit_and_score_kernel)(clone(base_estimator), K, y, scorer, parameter_list, folds,
+                                                         store, self.fit_timeout, keep)
+                        for K, parameter_list, precomputed in units)
+                    out.extend(self._kept([result for part in parts for result in part], keep))
+
+                for K in kernels:
+                    shared.release(K)
+        finally:
+            shared.close()
+
+        return out
+
+    def _evaluate_folds(self, base_estimator, y, cv, units, scorer, store=None, keep=False, n_jobs=None):
+        """Evaluate candidates with every (candidates, fold) pair scheduled as its own task.
+
+        units are (X, parameter_list, precomputed) triples: the candidates of parameter_list are fitted on the
+        windows X or, with precomputed, on the kernel matrix X of their shared gamma. Units are dispatched in
+        chunks of about fold_chunk_size candidates; once all folds of a chunk are back, each candidate's
+        out-of-fold probability vector is assembled and scored, so only one chunk of probabilities is held at a
+        time. n_jobs overrides the estimator's number of local workers.
+        """
+        folds = list(cv)
+
+        def tasks(chunk):
+            return [(X, clone(base_estimator), (parameter_list, train, test, precomputed, self.fit_timeout))
+                    for X, parameter_list, precomputed in chunk for train, test in folds]
+
+        if self.work_queue is not None:
+            queue = WorkQueue(self.work_queue, self.task_timeout)
+            return self._score_chunks(units, folds, y, scorer, store, keep,
+                                      lambda chunk: queue.map(fold_fit_and_predict, y, tasks(chunk)))
+
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        with Parallel(n_jobs=n_jobs, verbose=self.verbose, pre_dispatch=self.pre_dispatch) as parallel:
+            return self._score_chunks(units, folds, y, scorer, store, keep, lambda chunk: parallel(
+                delayed(fold_fit_and_predict)(estimator, X, y, *arguments) for X, estimator, arguments in tasks(chunk)))
+
+    def _score_chunks(self, units, folds, y, scorer, store, keep, run):
+        """Run the fold tasks of each chunk of units with run, then assemble and score its candidates in order."""
+        chunks = []
+        for unit in units:
+            if chunks and sum(len(other[1]) for other in chunks[-1]) + len(unit[1]) <= self.fold_chunk_size:
+                chunks[-1].append(unit)
+            else:
+                chunks.append([unit])
+
+        out = []
+        for chunk in chunks:
+            fold_probs = iter(run(chunk))
+
+            for X, parameter_list, precomputed in chunk:
+                cv_probs_ = np.zeros((len(parameter_list), len(y)))
+                for train, test in folds:
+                    for i, temp in enumerate(next(fold_probs)):
+                        cv_probs_[i, test] = temp
+                scores = score_candidates(scorer, cv_probs_, y)
+                for score, parameters, probs in zip(scores, parameter_list, cv_probs_):
+                    if store is not None:
+                        store.put(parameters, scorer, score, probs)
+                    if keep:
+                        self._keep(score, parameters, probs)
+                    out.append([score, parameters])
+
+        return out
+
+
+class ModifiedGridSearchCV(ModifiedSearchMixin, GridSearchCV):
+    def __init__(self, estimator, param_grid, scoring=None, fit_params=None,
+                 n_jobs=1, iid=True, refit=True, cv=None, verbose=0,
+                 pre_dispatch='2*n_jobs', error_score='raise', precompute_kernel=False,
+                 kernel_cache_mb=None, memmap_folder=None, fold_parallel=False, fold_chunk_size=64,
+                 result_store=None, keep_probs=0, fit_timeout=None,
+                 work_queue=None, task_timeout=600):
+
+        super(ModifiedGridSearchCV, self).__init__(
+            estimator, param_grid, scoring, fit_params, n_jobs, iid,
+            refit, cv, verbose, pre_dispatch, error_score)
+        self.precompute_kernel = precompute_kernel
+        self.kernel_cache_mb = kernel_cache_mb
+        self.memmap_folder = memmap_folder
+        self.fold_parallel = fold_parallel
+        self.fold_chunk_size = fold_chunk_size
+        self.result_store = result_store
+        self.keep_probs = keep_probs
+        self.fit_timeout = fit_timeout
+        self.work_queue = work_queue
+        self.task_timeout = task_timeout
+
+    def fit(self, X, y):
+        """Actual fitting,  performing the search over parameters."""
+        return self._fit(X, y, ParameterGrid(self.param_grid))
+
+
+class ModifiedRandomizedSearchCV(ModifiedSearchMixin, RandomizedSearchCV):
+    def __init__(self, estimator, param_distributions, n_iter=10, scoring=None,
+                 fit_params=None, n_jobs=1, iid=True, refit=True, cv=None,
+                 verbose=0, pre_dispatch='2*n_jobs', random_state=None,
+                 error_score='raise', precompute_kernel=False, kernel_cache_mb=None, memmap_folder=None,
+                 fold_parallel=False, fold_chunk_size=64, result_store=None, keep_probs=0, fit_timeout=None,
+                 work_queue=None, task_timeout=600):
+
+        super(ModifiedRandomizedSearchCV, self).__init__(estimator=estimator, param_distributions=param_distributions,
+                                                         n_iter=n_iter, scoring=scoring, random_state=random_state,
+                                                         fit_params=fit_params, n_jobs=n_jobs, iid=iid, refit=refit,
+                                                         cv=cv, verbose=verbose, pre_dispatch=pre_dispatch,
+                                                         error_score=error_score)
+        self.precompute_kernel = precompute_kernel
+        self.kernel_cache_mb = kernel_cache_mb
+        self.memmap_folder = memmap_folder
+        self.fold_parallel = fold_parallel
+        self.fold_chunk_size = fold_chunk_size
+        self.result_store = result_store
+        self.keep_probs = keep_probs
+        self.fit_timeout = fit_timeout
+        self.work_queue = work_queue
+        self.task_timeout = task_timeout
+
+    def fit(self, X, y):
+        """Actual fitting,  performing the search over parameters."""
+        return self._fit(X, y, ParameterSampler(self.param_distributions,
+                                                self.n_iter,
+                                                random_state=self.random_state))
+
+
+class ModifiedHalvingSearchCV(ModifiedSearchMixin, GridSearchCV):
+    """Successive halving over subject folds.
+
+    Every candidate of param_grid is first cross-validated on min_folds randomly chosen folds and scored on
+    those folds' test windows only. The best 1/factor of the candidates survive and are evaluated again on
+    factor times as many folds, until the survivors are run on all folds. best_params_ and best_score_ come
+    from that last, full round; rounds_ lists the (folds, candidates) of every round.
+    """
+
+    def __init__(self, estimator, param_grid, scoring=None, fit_params=None,
+                 n_jobs=1, iid=True, refit=True, cv=None, verbose=0,
+                 pre_dispatch='2*n_jobs', error_score='raise', precompute_kernel=False,
+                 kernel_cache_mb=None, memmap_folder=None, fold_parallel=False, fold_chunk_size=64,
+                 result_store=None, keep_probs=0, fit_timeout=None,
+                 work_queue=None, task_timeout=600, factor=3, min_folds=2, random_state=None):
+
+        super(ModifiedHalvingSearchCV, self).__init__(
+            estimator, param_grid, scoring, fit_params, n_jobs, iid,
+            refit, cv, verbose, pre_dispatch, error_score)
+        self.precompute_kernel = precompute_kernel
+        self.kernel_cache_mb = kernel_cache_mb
+        self.memmap_folder = memmap_folder
+        self.fold_parallel = fold_parallel
+        self.fold_chunk_size = fold_chunk_size
+        self.result_store = result_store
+        self.keep_probs = keep_probs
+        self.fit_timeout = fit_timeout
+        self.work_queue = work_queue
+        self.task_timeout = task_timeout
+        self.factor = factor
+        self.min_folds = min_folds
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """Actual fitting,  performing the search over parameters."""
+        return self._fit(X, y, ParameterGrid(self.param_grid))
+
+    def _search(self, base_estimator, X, y, cv, parameter_iterable):
+        candidates = list(parameter_iterable)
+        folds = list(cv)
+        order = check_random_state(self.random_state).permutation(len(folds))
+
+        self.rounds_ = []
+        n_folds = self.min_folds
+        while n_folds < len(folds) and len(candidates) > 1:
+            subset = [folds[i] for i in sorted(order[:n_folds])]
+            scorer = SubsetScorer(self.scoring, np.concatenate([test for train, test in subset]))
+
+            if self.verbose > 0:
+                print("Halving round: {0} candidates on {1} of {2} folds".format(len(candidates), n_folds,
+                                                                                len(folds)))
+            out = self._evaluate(base_estimator, X, y, subset, candidates, scorer)
+            self.rounds_.append((n_folds, len(candidates)))
+
+            n_keep = max(1, int(np.ceil(len(candidates) / float(self.factor))))
+            candidates = [parameters for score, parameters in sorted(out, reverse=True)[:n_keep]]
+            n_folds *= self.factor
+
+        if self.verbose > 0:
+            print("Halving round: {0} candidates on all {1} folds".format(len(candidates), len(folds)))
+        self.rounds_.append((len(folds), len(candidates)))
+
+        return self._evaluate(base_estimator, X, y, folds, candidates, self.scoring)
+
+
+class ModifiedRefineSearchCV(ModifiedSearchMixin, GridSearchCV):
+    """Coarse-to-fine search over log2(C) and log2(gamma).
+
+    The range of C and gamma is taken from param_grid, which is first covered by a lattice with coarse_step
+    spacing in log2. The step is then halved and the 3 x 3 neighbourhood of each of the top_k candidates so
+    far, with the same class_weight, is evaluated, until the step reaches final_step. The other entries of
+    param_grid (kernel, class_weight) are searched exhaustively. rounds_ lists the (step, candidates) of
+    every round.
+    """
+
+    def __init__(self, estimator, param_grid, scoring=None, fit_params=None,
+                 n_jobs=1, iid=True, refit=True, cv=None, verbose=0,
+                 pre_dispatch='2*n_jobs', error_score='raise', precompute_kernel=False,
+                 kernel_cache_mb=None, memmap_folder=None, fold_parallel=False, fold_chunk_size=64,
+                 result_store=None, keep_probs=0, fit_timeout=None,
+                 work_queue=None, task_timeout=600, coarse_step=2.0, final_step=0.5, top_k=5):
+
+        super(ModifiedRefineSearchCV, self).__init__(
+            estimator, param_grid, scoring, fit_params, n_jobs, iid,
+            refit, cv, verbose, pre_dispatch, error_score)
+        self.precompute_kernel = precompute_kernel
+        self.kernel_cache_mb = kernel_cache_mb
+        self.memmap_folder = memmap_folder
+        self.fold_parallel = fold_parallel
+        self.fold_chunk_size = fold_chunk_size
+        self.result_store = result_store
+        self.keep_probs = keep_probs
+        self.fit_timeout = fit_timeout
+        self.work_queue = work_queue
+        self.task_timeout = task_timeout
+        self.coarse_step = coarse_step
+        self.final_step = final_step
+        self.top_k = top_k
+
+    def fit(self, X, y):
+        """Actual fitting,  performing the search over parameters."""
+        return self._fit(X, y, ParameterGrid(self.param_grid))
+
+    def _search(self, base_estimator, X, y, cv, parameter_iterable):
+        C_range = np.log2([min(self.param_grid['C']), max(self.param_grid['C'])])
+        gamma_range = np.log2([min(self.param_grid['gamma']), max(self.param_grid['gamma'])])
+
+        step = float(self.coarse_step)
+        lattice = [(log2C, log2gamma)
+                   for log2C in np.arange(C_range[0], C_range[1] + 1e-9, step)
+                   for log2gamma in np.arange(gamma_range[0], gamma_range[1] + 1e-9, step)]
+        others = ParameterGrid(dict((k, v) for k, v in self.param_grid.items() if k not in ['C', 'gamma']))
+        cells = [(log2C, log2gamma, rest) for rest in others for log2C, log2gamma in lattice]
+
+        self.rounds_ = []
+        exponents = {}
+        out = []
+        while True:
+            candidates = []
+            for log2C, log2gamma, rest in cells:
+                parameters = dict(rest, C=2.0 ** log2C, gamma=2.0 ** log2gamma)
+                key = canonical_params(parameters)
+                if key not in exponents:
+                    exponents[key] = (log2C, log2gamma)
+                    candidates.append(parameters)
+
+            if self.verbose > 0:
+                print("Refinement round: {0} candidates at log2 step {1}".format(len(candidates), step))
+            out.extend(self._evaluate(base_estimator, X, y, cv, candidates, self.scoring))
+            self.rounds_.append((step, len(candidates)))
+
+            if step <= self.final_step:
+                break
+
+            step /= 2.0
+            cells = []
+            for score, parameters in sorted(out, reverse=True)[:self.top_k]:
+                log2C, log2gamma = exponents[canonical_params(parameters)]
+                rest = dict((k, v) for k, v in parameters.items() if k not in ['C', 'gamma'])
+                for dC in [-step, 0.0, step]:
+                    for dgamma in [-step, 0.0, step]:
+                        if (C_range[0] <= log2C + dC <= C_range[1] and
+                                gamma_range[0] <= log2gamma + dgamma <= gamma_range[1]):
+                            cells.append((log2C + dC, log2gamma + dgamma, rest))
+
+        return out
+
+
+class ModifiedBayesSearchCV(ModifiedSearchMixin, GridSearchCV):
+    """Sequential model-based search over the candidates of param_grid.
+
+    Candidates are encoded as log2(C), log2(gamma) and the position of every other searched value in its
+    list, scaled to [0, 1]. After n_initial random candidates, a Gaussian process surrogate is fitted to the
+    scores so far and batches of batch_size candidates (by default one per worker) are proposed by expected
+    improvement, each later one of a batch assuming the predicted score for the earlier ones. The search stops
+    after n_iter candidates, or once patience batches in a row improved the best score by less than tol.
+    rounds_ lists the (candidates, best score) after every batch.
+    """
+
+    def __init__(self, estimator, param_grid, scoring=None, fit_params=None,
+                 n_jobs=1, iid=True, refit=True, cv=None, verbose=0,
+                 pre_dispatch='2*n_jobs', error_score='raise', precompute_kernel=False,
+                 kernel_cache_mb=None, memmap_folder=None, fold_parallel=False, fold_chunk_size=64,
+                 result_store=None, keep_probs=0, fit_timeout=None,
+                 work_queue=None, task_timeout=600, n_iter=200, n_initial=20, batch_size=None, patience=3,
+                 tol=1e-4, random_state=None):
+
+        super(ModifiedBayesSearchCV, self).__init__(
+            estimator, param_grid, scoring, fit_params, n_jobs, iid,
+            refit, cv, verbose, pre_dispatch, error_score)
+        self.precompute_kernel = precompute_kernel
+        self.kernel_cache_mb = kernel_cache_mb
+        self.memmap_folder = memmap_folder
+        self.fold_parallel = fold_parallel
+        self.fold_chunk_size = fold_chunk_size
+        self.result_store = result_store
+        self.keep_probs = keep_probs
+        self.fit_timeout = fit_timeout
+        self.work_queue = work_queue
+        self.task_timeout = task_timeout
+        self.n_iter = n_iter
+        self.n_initial = n_initial
+        self.batch_size = batch_size
+        self.patience = patience
+        self.tol = tol
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """Actual fitting,  performing the search over parameters."""
+        return self._fit(X, y, ParameterGrid(self.param_grid))
+
+    def _encode(self, candidates):
+        columns = []
+        for key in sorted(self.param_grid):
+            values = list(self.param_grid[key])
+            if len(values) < 2:
+                continue
+            if key in ['C', 'gamma']:
+                column = np.log2([parameters[key] for parameters in candidates])
+            else:
+                column = np.array([values.index(parameters[key]) for parameters in candidates], dtype=np.float64)
+            span = column.max() - column.min()
+            columns.append((column - column.min()) / (span if span > 0 else 1.0))
+
+        return np.column_stack(columns) if columns else np.zeros((len(candidates), 1))
+
+    def _propose(self, Z, evaluated, scores, n, random_state):
+        """Pick n unevaluated rows of Z by expected improvement under a Gaussian process fitted to scores."""
+        scores = np.asarray(scores, dtype=np.float64)
+        finite = scores[np.isfinite(scores)]
+        scores = np.where(np.isfinite(scores), scores, finite.min() if len(finite) else 0.0)  # failed fits
+        scores = (scores - scores.mean()) / (scores.std() if scores.std() > 0 else 1.0)
+        pending = np.setdiff1d(np.arange(len(Z)), evaluated)
+
+        # Length scale by marginal likelihood over a small set, with a fixed noise level for noisy CV scores
+        noise = 1e-2
+        best_fit = None
+        for length in [0.05, 0.1, 0.2, 0.4, 0.8]:
+            K = rbf_kernel(Z[evaluated], gamma=0.5 / length ** 2) + noise * np.eye(len(evaluated))
+            factor = cho_factor(K)
+            weights = cho_solve(factor, scores)
+            likelihood = -0.5 * np.dot(scores, weights) - np.sum(np.log(np.diag(factor[0])))
+            if best_fit is None or likelihood > best_fit[0]:
+                best_fit = (likelihood, length)
+        gamma = 0.5 / best_fit[1] ** 2
+
+        chosen = []
+        observed = list(evaluated)
+        targets = list(scores)
+        best = scores.max()
+        for k in range(min(n, len(pending))):
+            factor = cho_factor(rbf_kernel(Z[observed], gamma=gamma) + noise * np.eye(len(observed)))
+            K_pending = rbf_kernel(Z[pending], Z[observed], gamma=gamma)
+            mean = np.dot(K_pending, cho_solve(factor, np.asarray(targets)))
+            variance = 1.0 - np.sum(K_pending * cho_solve(factor, K_pending.T).T, axis=1)
+            sd = np.sqrt(np.maximum(variance, 1e-12))
+
+            z = (mean - best) / sd
+            improvement = (mean - best) * norm.cdf(z) + sd * norm.pdf(z)
+            improvement += 1e-12 * random_state.rand(len(pending))  # random tie break
+            pick = np.argmax(improvement)
+
+            chosen.append(pending[pick])
+            observed.append(pending[pick])
+            targets.append(mean[pick])
+            pending = np.delete(pending, pick)
+
+        return chosen
+
+    def _search(self, base_estimator, X, y, cv, parameter_iterable):
+        candidates = list(parameter_iterable)
+        Z = self._encode(candidates)
+        random_state = check_random_state(self.random_state)
+
+        batch_size = self.batch_size
+        if batch_size is None:
+            batch_size = effective_n_jobs(self.n_jobs)
+        n_iter = min(self.n_iter, len(candidates))
+
+        self.rounds_ = []
+        out = []
+        evaluated = []
+        stale = 0
+        while len(evaluated) < n_iter and stale < self.patience:
+            n = min(batch_size, n_iter - len(evaluated))
+            if len(evaluated) < self.n_initial:
+                pending = np.setdiff1d(np.arange(len(candidates)), evaluated)
+                batch = list(random_state.choice(pending, min(max(n, self.n_initial - len(evaluated)),
+                                                               n_iter - len(evaluated)), replace=False))
+            else:
+                batch = self._propose(Z, evaluated, [score for score, parameters in out], n, random_state)
+
+            previous = max(out)[0] if out else None
+            out.extend(self._evaluate(base_estimator, X, y, cv, [candidates[i] for i in batch], self.scoring))
+            evaluated.extend(batch)
+
+            best = max(out)[0]
+            if previous is not None and len(evaluated) > self.n_initial:
+                stale = stale + 1 if best - previous < self.tol else 0
+            self.rounds_.append((len(evaluated), best))
+            if self.verbose > 0:
+                print("Model-based round: {0} candidates evaluated, best score {1}".format(len(evaluated), best))
+
+        return out
+
+
+def readCached(f, parse, cacheFolder=None):
+    """Return parse(f), a dict of arrays, reusing an .npz copy kept in cacheFolder.
+
+    The copy is named after the file's path and carries its size and mtime; it is rebuilt as soon as
+    either changes. Without a cacheFolder the file is simply parsed.
+    """
+    if cacheFolder is None:
+        return parse(f)
+
+    stat = f.stat()
+    source = str(f.resolve())
+    cacheFile = Path(cacheFolder) / (hashlib.sha1(source.encode('utf-8')).hexdigest() + '.npz')
+
+    if cacheFile.exists():
+        with np.load(str(cacheFile)) as cached:
+            if cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+                return dict((k, cached[k]) for k in cached.files if k not in ['size', 'mtime'])
+
+    data = parse(f)
+
+    if not Path(cacheFolder).exists():
+        Path(cacheFolder).mkdir(parents=True)
+    temp = cacheFile.with_suffix('.tmp')
+    with temp.open('wb') as out:
+        np.savez(out, size=stat.st_size, mtime=stat.st_mtime, **data)
+    temp.rename(cacheFile)
+
+    return data
+
+
+def parseCSVBlock(f):
+    """Parse a purely numeric CSV file into a 2-D float64 array with NumPy's C parser."""
+    with f.open('rb') as file:
+        text = file.read().strip()
+
+    if not text:
+        return np.zeros((0, 0))
+
+    rows = text.count(b'\n') + 1
+    block = np.fromstring(text.replace(b'\n', b','), dtype=np.float64, sep=',')
+    if block.size % rows != 0:
+        raise ValueError('Malformed CSV file %s' % f)
+
+    return block.reshape(rows, -1)
+
+
+def writeFeatureStore(chunks, folder, chunk_size=100000):
+    """Write (features, labels, participants) chunks to a disk-backed store in folder.
+
+    Chunks are appended to a raw float64 file while StandardScaler statistics are accumulated with
+    partial_fit; the file is then normalized in place, chunk_size rows at a time. Returns the normalized
+    features as a read-only memmap, the labels, the participant IDs and the fitted scaler.
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    filename = os.path.join(folder, 'features.dat')
+
+    normalizer = preprocessing.StandardScaler()
+    labels = []
+    subjects = []
+    n_features = None
+    with open(filename, 'wb') as f:
+        for features, featureLabels, participants in chunks:
+            if len(featureLabels) == 0:
+                continue
+            normalizer.partial_fit(features)
+            f.write(np.ascontiguousarray(features, dtype=np.float64).tostring())
+            labels.append(featureLabels)
+            subjects.append(participants)
+            n_features = features.shape[1]
+
+    if n_features is None:
+        raise ValueError('No labeled windows to store in %s' % folder)
+    labels = np.concatenate(labels)
+    subjects = np.concatenate(subjects)
+
+    features = np.memmap(filename, dtype=np.float64, mode='r+', shape=(len(labels), n_features))
+    for start in range(0, len(labels), chunk_size):
+        features[start:start + chunk_size] = normalizer.transform(features[start:start + chunk_size])
+    features.flush()
+    del features
+
+    np.save(os.path.join(folder, 'labels.npy'), labels)
+    np.save(os.path.join(folder, 'subjects.npy'), subjects)
+
+    features = np.memmap(filename, dtype=np.float64, mode='r', shape=(len(labels), n_features))
+    return features, labels, subjects, normalizer
+
+
+def get_svmdataset(traindata, trainlabels):
+    input = []
+    output = []
+    foldinds = []
+
+    for i in range(len(trainlabels)):
+        if trainlabels[i] == 1:
+            foldinds.append(i)
+
+        if trainlabels[i] == 0:
+            foldinds.append(i)
+
+    input = np.array(input, dtype='float64')
+    return output, input, foldinds
+
+
+def reduceData(data, r):
+    result = []
+    for d in data:
+        result.append([d[i] for i in r])
+    return result
+
+
+def f1Bias_scorer(estimator, X, y, ret_bias=False):
+    probas_ = estimator.predict_proba(X)
+    precision, recall, thresholds = metrics.precision_recall_curve(y, probas_[:, 1])
+
+    f1, bias = best_f1_threshold(precision, recall, thresholds)
+
+    if ret_bias:
+        return f1, bias
+    else:
+        return f1
+
+
+def Twobias_scorer_CV(probs, y, ret_bias=False):
+    """Smallest fraction of windows left unclassified between two thresholds so that both classes reach 0.95.
+
+    Windows are sorted by probability; those up to index i are called negative, those after index j positive
+    and the ones in between are rejected. For a fixed i, growing j can only raise the negative rate and lower
+    the positive rate, so the best j is the first one that meets the negative rate. It is found for every i at
+    once by a vectorized bisection over cumulative class counts, in O(n log n).
+    """
+    db = np.transpose(np.vstack([probs, y]))
+    db = db[np.argsort(db[:, 0]), :]
+
+    pos = np.sum(y == 1)
+    n = len(y)
+    neg = n - pos
+
+    optbias = []
+    minloss = 1
+
+    if pos == 0 or neg == 0:
+        if ret_bias:
+            return -minloss, optbias
+        else:
+            return -minloss
+
+    cumpos = np.concatenate([[0], np.cumsum(db[:, 1] == 1)]).astype(np.float64)
+    cumneg = np.arange(n + 1, dtype=np.float64) - cumpos
+
+    def band(i, j):
+        # Counts with windows [0, i] called negative, (i, j] rejected and (j, n) called positive
+        running_tp = pos - cumpos[j + 1]
+        running_tn = cumneg[i + 1]
+        running_pos = running_tp + cumpos[i + 1]
+        running_neg = running_tn + (neg - cumneg[j + 1])
+        return running_tp, running_pos, running_tn, running_neg
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tp = pos - cumpos[1:]
+        tn = cumneg[1:]
+        single = np.logical_and(tp / pos >= 0.95, tn / neg >= 0.95)
+
+        lower = np.where(np.logical_not(single[:-1]))[0]
+        lo = lower + 1
+        hi = np.zeros(len(lower), dtype=lo.dtype) + n
+        while np.any(lo < hi):
+            active = lo < hi
+            mid = (lo + hi) // 2
+            running_tp, running_pos, running_tn, running_neg = band(lower, np.minimum(mid, n - 1))
+            stop = (running_pos == 0) | (running_neg == 0) | (running_tn / running_neg >= 0.95)
+            hi = np.where(active & stop, mid, hi)
+            lo = np.where(active & ~stop, mid + 1, lo)
+
+        found = lo < n
+        lower, upper = lower[found], lo[found]
+        running_tp, running_pos, running_tn, running_neg = band(lower, upper)
+        valid = ((running_pos > 0) & (running_neg > 0) &
+                 (running_tp / running_pos >= 0.95) & (running_tn / running_neg >= 0.95))
+
+    last = -1
+    if np.any(valid):
+        lower, upper = lower[valid], upper[valid]
+        best = np.argmin(upper - lower)
+        minloss = (upper[best] - lower[best]) * 1.0 / n
+        optbias = [db[lower[best], 0], db[upper[best], 0]]
+        last = lower[best]
+
+    # A single threshold that already meets both rates overrides any band found for a smaller i
+    if np.any(single) and np.where(single)[0][-1] > last:
+        i = np.where(single)[0][-1]
+        optbias = [db[i, 0], db[i, 0]]
+
+    if ret_bias:
+        return -minloss, optbias
+    else:
+        return -minloss
+
+
+def best_f1_threshold(precision, recall, thresholds):
+    """Highest F1 over a precision-recall curve and the lowest threshold attaining it ([] if F1 is 0 everywhere)."""
+    precision = precision[:len(thresholds)]
+    recall = recall[:len(thresholds)]
+
+    denominator = precision + recall
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = np.where(denominator > 0, 2 * (precision * recall) / denominator, 0.0)
+
+    if len(f) == 0 or not f.max() > 0.0:
+        return 0.0, []
+
+    i = np.argmax(f)
+    return f[i], thresholds[i]
+
+
+def f1Bias_scorer_CV(probs, y, ret_bias=False):
+    precision, recall, thresholds = metrics.precision_recall_curve(y, probs)
+
+    f1, bias = best_f1_threshold(precision, recall, thresholds)
+
+    if ret_bias:
+        return f1, bias
+    else:
+        return f1
+
+
+def f1Bias_scorer_CV_batch(probs, y, ret_bias=False, block_mb=64):
+    """f1Bias_scorer_CV for a 2-D array holding one out-of-fold probability vector per row.
+
+    Rebuilds the precision-recall curves of a block of rows at once (same ordering and arithmetic as
+    metrics.precision_recall_curve), so a chunk of candidates is scored without a Python loop over them. The
+    block's temporaries, about a dozen arrays of its shape, take about block_mb megabytes.
+    Returns an array of scores and, with ret_bias, the list of matching thresholds.
+    """
+    probs = np.atleast_2d(np.asarray(probs, dtype=np.float64))
+    y = np.asarray(y) == 1
+    m, n = probs.shape
+    rows = max(1, int(block_mb * 2 ** 20 // (12 * 8 * max(n, 1))))
+
+    f1 = np.zeros(m)
+    bias = []
+    for start in range(0, m, rows):
+        f1[start:start + rows], block_bias = _f1_rows(probs[start:start + rows], y)
+        bias.extend(block_bias)
+
+    if ret_bias:
+        return f1, bias
+    else:
+        return f1
+
+
+def _f1_rows(probs, y):
+    """Best F1 and its threshold ([] if F1 is 0 everywhere) of every row of probs, for f1Bias_scorer_CV_batch."""
+    m, n = probs.shape
+    rows = np.arange(m)[:, np.newaxis]
+
+    order = np.argsort(probs, axis=1, kind='mergesort')[:, ::-1]
+    scores = probs[rows, order]
+    tps = np.cumsum(y[order], axis=1, dtype=np.float64)
+    fps = 1 + np.arange(n) - tps
+
+    # A threshold sits at the last index of every run of equal scores; curves stop at full recall
+    distinct = np.ones((m, n), dtype=bool)
+    distinct[:, :-1] = scores[:, :-1] != scores[:, 1:]
+    total = tps[:, -1:]
+    full_recall = np.argmax(distinct & (tps == total), axis=1)
+    valid = distinct & (np.arange(n) <= full_recall[:, np.newaxis]) & (total > 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tps / (tps + fps)
+        recall = tps / total
+        denominator = precision + recall
+        f = np.where(valid & (denominator > 0), 2 * (precision * recall) / denominator, 0.0)
+
+    # Ties go to the lowest threshold, i.e. the highest index in descending score order
+    best = n - 1 - np.argmax(f[:, ::-1], axis=1)
+    f1 = f[np.arange(m), best]
+    f1[~(f1 > 0.0)] = 0.0
+
+    return f1, [scores[i, best[i]] if f1[i] > 0.0 else [] for i in range(m)]
+
+
+class SubsetScorer(object):
+    """Wraps a scorer so that it only looks at the windows in indices, e.g. the test windows of some folds."""
+
+    def __init__(self, scorer, indices):
+        self.scorer = scorer
+        self.indices = indices
+        self.__name__ = scorer.__name__
+
+    def __call__(self, probs, y, ret_bias=False):
+        return self.scorer(probs[self.indices], y[self.indices], ret_bias)
+
+
+class MultiScore(float):
+    """The score of a MultiScorer's first scorer, which ranks candidates, carrying every scorer's score by name."""
+
+    def __new__(cls, scores, names):
+        score = float.__new__(cls, scores[0])
+        score.names = names
+        score.scores = dict(zip(names, scores))
+        return score
+
+    def __reduce__(self):
+        return MultiScore, ([self.scores[name] for name in self.names], self.names)
+
+
+class MultiScorer(object):
+    """Scores one out-of-fold probability vector with several scorers at once.
+
+    The first scorer ranks the candidates; the scores of the others ride along in the returned MultiScore.
+    """
+
+    def __init__(self, scorers):
+        self.scorers = scorers
+        self.names = [scorer.__name__ for scorer in scorers]
+        self.__name__ = '+'.join(self.names)
+
+    def __call__(self, probs, y, ret_bias=False):
+        if ret_bias:
+            return self.scorers[0](probs, y, True)
+        return MultiScore([scorer(probs, y) for scorer in self.scorers], self.names)
+
+
+# Score of a candidate with a failed fit, whose out-of-fold vector holds NaN; it ranks below any real score
+FAILED_SCORE = -np.inf
+
+
+def score_candidates(scorer, probs, y):
+    """Score a 2-D array of out-of-fold probability vectors, one row per candidate, with scorer."""
+    if isinstance(scorer, SubsetScorer):
+        return score_candidates(scorer.scorer, probs[:, scorer.indices], y[scorer.indices])
+    if isinstance(scorer, MultiScorer):
+        scores = [score_candidates(one, probs, y) for one in scorer.scorers]
+        return [MultiScore(candidate, scorer.names) for candidate in zip(*scores)]
+    failed = np.any(np.isnan(probs), axis=1)
+    if np.any(failed):
+        scores = iter(score_candidates(scorer, probs[~failed], y) if not np.all(failed) else [])
+        return [FAILED_SCORE if fail else next(scores) for fail in failed]
+    if scorer is f1Bias_scorer_CV:
+        return list(f1Bias_scorer_CV_batch(probs, y))
+    return [scorer(p, y) for p in probs]
+
+
+def svmOutput(filename, traindata, trainlabels):
+    with open(filename, 'w') as f:
+        for i in range(0, len(trainlabels)):
+            f.write(str(trainlabels[i]))
+            for fi in range(0, len(traindata[i])):
+                f.write(" " + str(fi + 1) + ":" + str(traindata[i][fi]))
+
+            f.write("\n")
+
+
+def modelArrays(model, normparams):
+    """The parameters of a fitted binary RBF SVC and its normalizer as contiguous float64 arrays."""
+    return {'supportVectors': np.ascontiguousarray(model.support_vectors_, dtype=np.float64),
+            'dualCoef': np.ascontiguousarray(model.dual_coef_[0], dtype=np.float64),
+            'mean': np.ascontiguousarray(normparams.mean_, dtype=np.float64),
+            'std': np.ascontiguousarray(normparams.scale_, dtype=np.float64),
+            'intercept': float(model.intercept_[0]),
+            'gamma': float(model._gamma),
+            'probA': float(model.probA_[0]),
+            'probB': float(model.probB_[0])}
+
+
+def saveModel(filename, model, normparams, bias=0.5, modelName='cStress'):
+    arrays = modelArrays(model, normparams)
+
+    model = {'modelName': modelName, 'modelType': 'svc',
+             'intercept': arrays['intercept'], 'bias': bias, 'probA': arrays['probA'], 'probB': arrays['probB'],
+             'kernel': {'type': 'rbf', 'parameters': [{'name': 'gamma', 'value': arrays['gamma']}]},
+             'support': [{'dualCoef': dualCoef, 'supportVector': supportVector} for dualCoef, supportVector in
+                         zip(arrays['dualCoef'].tolist(), arrays['supportVectors'].tolist())],
+             'normparams': [{'mean': mean, 'std': std} for mean, std in
+                            zip(arrays['mean'].tolist(), arrays['std'].tolist())]}
+
+    with open(filename, 'w') as f:
+        print >> f, json.dumps(model, sort_keys=True, indent=4)
+
+
+def saveModelBinary(filename, model, normparams, bias=0.5, modelName='cStress'):
+    """Write the model in the binary layout described in predict.py. A single bias is stored as a [bias, bias]
+    pair.
+    """
+    arrays = modelArrays(model, normparams)
+
+    header = np.zeros(1, dtype=MODEL_HEADER)
+    header['magic'] = MODEL_MAGIC
+    header['version'] = MODEL_VERSION
+    header['supportVectors'], header['features'] = arrays['supportVectors'].shape
+    header['modelName'] = modelName.encode('ascii')
+    for name in ['intercept', 'gamma', 'probA', 'probB']:
+        header[name] = arrays[name]
+    header['bias'] = bias
+
+    with open(filename, 'wb') as f:
+        f.write(header.tostring())
+        for name in ['mean', 'std', 'dualCoef', 'supportVectors']:
+            f.write(arrays[name].astype('<f8').tostring())
+
+
+def predict_scores(estimator, X):
+    """Class 1 probabilities, or decision function values for an SVC built with probability=False.
+
+    Both rank windows the same way, which is all the scorers need, but the decision function does not cost the
+    internal cross-validation libsvm runs in every fit to calibrate probabilities.
+    """
+    if getattr(estimator, 'probability', True):
+        return estimator.predict_proba(X)[:, 1]
+    return estimator.decision_function(X)
+
+
+def fit_failed(estimator, X, y, fit_timeout=None):
+    """Fit estimator and tell whether the fit stopped at its max_iter or was stopped after fit_timeout seconds.
+
+    With fit_timeout, the fit runs in a forked child process that is killed at the deadline, so a fit that would
+    run for hours does not hold up its worker; the fitted estimator comes back pickled. Where os.fork does not
+    exist, the fit runs in this process and is only judged by its duration once it returns.
+    """
+    if fit_timeout is None or not hasattr(os, 'fork'):
+        start = time.time()
+        estimator.fit(X, y)
+        return (getattr(estimator, 'fit_status_', 0) != 0 or
+                (fit_timeout is not None and time.time() - start > fit_timeout))
+
+    fitted = fit_in_child(estimator, X, y, fit_timeout)
+    if fitted is None:
+        return True
+    estimator.__dict__.update(fitted.__dict__)
+    return getattr(estimator, 'fit_status_', 0) != 0
+
+
+def fit_in_child(estimator, X, y, timeout):
+    """Fitted copy of estimator from a forked child process, or None if the fit was not done within timeout
+    seconds and the child was killed. An exception of the fit is raised again here.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            try:
+                result = ('fitted', estimator.fit(X, y))
+            except Exception as error:
+                result = ('error', error)
+            try:
+                data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                data = pickle.dumps(('error', RuntimeError(traceback.format_exc())), pickle.HIGHEST_PROTOCOL)
+            with os.fdopen(write_fd, 'wb') as f:
+                f.write(data)
+            status = 0
+        finally:
+            # Leave without running the parent's cleanup handlers, such as joblib's
+            os._exit(status)
+
+    os.close(write_fd)
+    deadline = time.time() + timeout
+    chunks = []
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([read_fd], [], [], remaining)[0]:
+                os.kill(pid, signal.SIGKILL)
+                return None
+            chunk = os.read(read_fd, 2 ** 20)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+
+    if not chunks:
+        raise RuntimeError('The fit process %d exited without a result' % pid)
+    kind, value = pickle.loads(b''.join(chunks))
+    if kind == 'error':
+        raise value
+    return value
+
+
+def fit_predict_fold(estimator, X, y, train, test, fit_timeout=None):
+    """Test fold scores of a fit on the training fold, NaN if the fit failed."""
+    if fit_failed(estimator, X[train], y[train], fit_timeout):
+        return np.zeros(len(test)) + np.nan
+    return predict_scores(estimator, X[test])
+
+
+def cross_val_probs(estimator, X, y, cv, n_jobs=1, fit_timeout=None):
+    probs = np.zeros(len(y))
+
+    if n_jobs == 1:
+        for train, test in cv:
+            probs[test] = fit_predict_fold(estimator, X, y, train, test, fit_timeout)
+            if np.any(np.isnan(probs[test])):
+                # A failed fold fails the candidate, so the remaining folds are not fitted
+                return probs + np.nan
+    else:
+        folds = list(cv)
+        fold_probs = Parallel(n_jobs=n_jobs)(
+            delayed(fit_predict_fold)(clone(estimator), X, y, train, test, fit_timeout) for train, test in folds)
+        for (train, test), temp in zip(folds, fold_probs):
+            probs[test] = temp
+
+    return probs
+
+
+def platt_scaling(scores, y, max_iter=100):
+    """Fit Platt's sigmoid to decision function values, by the Newton method of Lin, Lin and Weng (2007) that
+    libsvm uses.
+
+    Returns (probA, probB) with the sign convention of saveModel, where the class 1 estimate is
+    1 / (1 + exp(probA * score - probB)).
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    prior1 = np.sum(y == 1)
+    prior0 = len(y) - prior1
+    target = np.where(y == 1, (prior1 + 1.0) / (prior1 + 2.0), 1.0 / (prior0 + 2.0))
+
+    def objective(A, B):
+        fApB = scores * A + B
+        return np.sum(np.where(fApB >= 0, target * fApB + np.log1p(np.exp(-np.abs(fApB))),
+                               (target - 1) * fApB + np.log1p(np.exp(-np.abs(fApB)))))
+
+    A, B = 0.0, np.log((prior0 + 1.0) / (prior1 + 1.0))
+    fval = objective(A, B)
+    for iteration in range(max_iter):
+        p = 1.0 / (1.0 + np.exp(scores * A + B))
+        d1 = target - p
+        d2 = p * (1 - p)
+        h11 = 1e-12 + np.sum(scores * scores * d2)
+        h22 = 1e-12 + np.sum(d2)
+        h21 = np.sum(scores * d2)
+        g1 = np.sum(scores * d1)
+        g2 = np.sum(d1)
+        if abs(g1) < 1e-5 and abs(g2) < 1e-5:
+            break
+
+        det = h11 * h22 - h21 * h21
+        dA = -(h22 * g1 - h21 * g2) / det
+        dB = -(-h21 * g1 + h11 * g2) / det
+        gd = g1 * dA + g2 * dB
+
+        step = 1.0
+        while step >= 1e-10:
+            newf = objective(A + step * dA, B + step * dB)
+            if newf < fval + 0.0001 * step * gd:
+                A, B, fval = A + step * dA, B + step * dB, newf
+                break
+            step /= 2.0
+        if step < 1e-10:
+            break
+
+    return A, -B
+
+
+def platt_probability(scores, probA, probB):
+    """Class 1 probabilities of decision function values, as SVC.predict_proba computes them."""
+    r = 1.0 / (1.0 + np.exp(probA * np.asarray(scores, dtype=np.float64) - probB))
+    return coupled_probability(np.clip(r, 1e-7, 1 - 1e-7))
+
+
+class NystroemSVC(BaseEstimator, ClassifierMixin):
+    """A linear model on a Nystroem approximation of the RBF kernel, with SVC's C, gamma and class_weight.
+
+    The kernel is approximated through n_components training windows drawn at random, and a LinearSVC (loss
+    'squared_hinge' or 'hinge') or a LogisticRegression (loss 'logistic') is trained on the mapped windows,
+    which costs time linear in the number of windows. The linear model folds back into a sum of RBF kernels on
+    the n_components windows, held in SVC's fitted attributes, so that the search ranks it on decision function
+    values and saveModel, saveModelBinary and predict.py take it unchanged, at a cost that does not grow with
+    the training set. fit_status_ is 1 when the linear solver stopped at max_iter.
+    """
+
+    probability = False
+
+    def __init__(self, C=1.0, kernel='rbf', gamma='auto', class_weight=None, n_components=500,
+                 loss='squared_hinge', tol=1e-4, max_iter=1000, random_state=None):
+        self.C = C
+        self.kernel = kernel
+        self.gamma = gamma
+        self.class_weight = class_weight
+        self.n_components = n_components
+        self.loss = loss
+        self.tol = tol
+        self.max_iter = max_iter
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        self._gamma = 1.0 / X.shape[1] if self.gamma == 'auto' else self.gamma
+        mapping = Nystroem(gamma=self._gamma, n_components=min(self.n_components, len(X)),
+                           random_state=self.random_state).fit(X)
+
+        if self.loss == 'logistic':
+            linear = LogisticRegression(C=self.C, class_weight=self.class_weight, tol=self.tol,
+                                        max_iter=self.max_iter, random_state=self.random_state)
+        else:
+            # The primal solver converges fast with far more windows than components; hinge loss needs the dual
+            linear = svm.LinearSVC(C=self.C, loss=self.loss, dual=self.loss == 'hinge', class_weight=self.class_weight,
+                                   tol=self.tol, max_iter=self.max_iter, random_state=self.random_state)
+        linear.fit(mapping.transform(X), y)
+
+        # transform(X) = K(X, components) . normalization^T, so w . transform(X) = K(X, components) . dual
+        self.classes_ = linear.classes_
+        self.support_vectors_ = mapping.components_
+        self.dual_coef_ = np.dot(mapping.normalization_.T, linear.coef_[0])[np.newaxis, :]
+        self.intercept_ = np.asarray(linear.intercept_, dtype=np.float64).reshape(1)
+        self.probA_ = np.array([])
+        self.probB_ = np.array([])
+        self.fit_status_ = int(np.max(getattr(linear, 'n_iter_', 0)) >= self.max_iter)
+
+        return self
+
+    def decision_function(self, X):
+        return np.dot(rbf_kernel(X, self.support_vectors_, gamma=self._gamma), self.dual_coef_[0]) + self.intercept_[0]
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(np.int)]
+
+    def predict_proba(self, X):
+        probs = platt_probability(self.decision_function(X), self.probA_[0], self.probB_[0])
+        return np.column_stack([1 - probs, probs])
+
+
+class ReducedSVC(object):
+    """A binary RBF SVC whose decision function is approximated with a reduced set of vectors.
+
+    The support vectors of each sign are clustered with k-means and the cluster centers become the reduced set.
+    Their coefficients and the intercept are then refit by least squares, so that the reduced decision function
+    matches the original one on the training windows. The Platt parameters are kept, and the fitted attributes
+    mirror SVC's so that saveModel and saveModelBinary write a ReducedSVC unchanged.
+    """
+
+    def __init__(self, n_vectors, random_state=None):
+        self.n_vectors = n_vectors
+        self.random_state = random_state
+
+    def fit(self, model, X):
+        alpha = model.dual_coef_[0]
+        n_vectors = min(self.n_vectors, len(alpha))
+        random_state = check_random_state(self.random_state)
+
+        centers = []
+        for side in [alpha > 0, alpha < 0]:
+            count = np.sum(side)
+            if count == 0:
+                continue
+            k = min(count, max(1, int(round(n_vectors * count * 1.0 / len(alpha)))))
+            if k == count:
+                centers.append(model.support_vectors_[side])
+            else:
+                kmeans = KMeans(n_clusters=k, n_init=3, random_state=random_state)
+                centers.append(kmeans.fit(model.support_vectors_[side]).cluster_centers_)
+        self.support_vectors_ = np.vstack(centers)
+        self._gamma = model._gamma
+
+        A = np.hstack([rbf_kernel(X, self.support_vectors_, gamma=self._gamma), np.ones((len(X), 1))])
+        coef = np.linalg.lstsq(A, model.decision_function(X))[0]
+        self.dual_coef_ = coef[np.newaxis, :-1]
+        self.intercept_ = coef[-1:]
+        self.probA_ = model.probA_
+        self.probB_ = model.probB_
+        self.probability = getattr(model, 'probability', True)
+
+        return self
+
+    def decision_function(self, X):
+        return np.dot(rbf_kernel(X, self.support_vectors_, gamma=self._gamma), self.dual_coef_[0]) + self.intercept_[0]
+
+    def predict_proba(self, X):
+        probs = platt_probability(self.decision_function(X), self.probA_[0], self.probB_[0])
+        return np.column_stack([1 - probs, probs])
+
+
+def compressed_size(model, factor):
+    return max(1, int(np.ceil(len(model.support_vectors_) * 1.0 / factor)))
+
+
+def fit_compress_fold(estimator, X, y, train, test, factors, random_state=None):
+    model = estimator.fit(X[train], y[train])
+
+    vectors = [len(model.support_vectors_)]
+    probs = [predict_scores(model, X[test])]
+    for factor in factors:
+        reduced = ReducedSVC(compressed_size(model, factor), random_state).fit(model, X[train])
+        vectors.append(len(reduced.support_vectors_))
+        probs.append(predict_scores(reduced, X[test]))
+
+    return vectors, probs
+
+
+def cross_val_probs_compressed(estimator, X, y, cv, factors, n_jobs=1, random_state=None):
+    """Out-of-fold probabilities of the estimator and of its ReducedSVC compressions by each factor in factors.
+
+    Returns the mean number of vectors per fold and a probability vector for the estimator itself followed by
+    one per factor, so the inference speedup of a compression is the first count over its own.
+    """
+    folds = list(cv)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_compress_fold)(clone(estimator), X, y, train, test, factors, random_state)
+        for train, test in folds)
+
+    vectors = np.mean([fold_vectors for fold_vectors, fold_probs in results], axis=0)
+    probs = np.zeros((len(factors) + 1, len(y)))
+    for (train, test), (fold_vectors, fold_probs) in zip(folds, results):
+        probs[:, test] = fold_probs
+
+    return vectors, probs